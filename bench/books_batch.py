@@ -0,0 +1,36 @@
+import sys
+import time
+from common import load_service, quiet
+
+# Throughput of adding books one POST /books request at a time against one POST /books/batch request:
+#   python bench/books_batch.py [books]
+books_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+service = load_service()
+with quiet():
+    service.create_databases()
+client = service.app.test_client()
+
+
+def books(prefix):
+    return [{'title': f'{prefix} {n}', 'author': f'Author {n % 50}', 'price': 5.0 + n % 20, 'quantity': n % 10}
+            for n in range(books_count)]
+
+
+def add_one_by_one():
+    for book in books('Single'):
+        response = client.post('/books', json=book)
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+
+def add_batch():
+    response = client.post('/books/batch', json=books('Batch'))
+    assert response.status_code == 200, response.get_data(as_text=True)
+
+
+for name, add in [('single POST /books', add_one_by_one), ('POST /books/batch', add_batch)]:
+    with quiet():
+        started = time.perf_counter()
+        add()
+        elapsed = time.perf_counter() - started
+    print(f'{name:20} {books_count} books in {elapsed * 1000:8.1f} ms, {books_count / elapsed:8.0f} books/s')
@@ -0,0 +1,61 @@
+import random
+import sys
+import time
+from sqlalchemy import insert
+from common import load_service, quiet, time_call
+
+# Query times of GET /books filters, keyset pages and full-text search over a large catalogue, measured on the
+# database queries themselves (the cache in front of them would answer repeated requests):
+#   python bench/books_query.py [rows]
+rows_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+seed_batch_size = 50000
+
+words = ['war', 'peace', 'river', 'night', 'garden', 'empire', 'winter', 'shadow', 'ocean', 'stone', 'silver',
+         'house', 'storm', 'secret', 'kingdom', 'journey', 'island', 'memory', 'fire', 'glass']
+authors_count = rows_count // 100 or 1
+
+service = load_service()
+
+
+# Deterministic books: titles of three words, authors with about 100 books each, prices between 1 and 100
+def seed_books():
+    generator = random.Random(0)
+    for start in range(0, rows_count, seed_batch_size):
+        rows = [{'title': ' '.join(generator.choices(words, k=3)),
+                 'author': f'Author {generator.randrange(authors_count)}',
+                 'price': round(generator.uniform(1, 100), 2),
+                 'quantity': generator.randrange(100)} for _ in range(min(seed_batch_size, rows_count - start))]
+        service.db.session.execute(insert(service.Book), rows)
+        service.db.session.commit()
+
+
+def load_page(**params):
+    page = {'limit': 50, 'after_id': None, 'fields': service.book_fields, 'sort': 'id', 'descending': False,
+            'filters': {}}
+    page.update(params)
+    return lambda: service.load_books_page(**page)
+
+
+with service.app.app_context():
+    started = time.perf_counter()
+    service.db.create_all()
+    seed_books()
+with quiet():
+    # The full-text index is filled from the seeded rows in one go
+    service.create_databases()
+print(f'Seeded {rows_count} books in {time.perf_counter() - started:.1f} s')
+
+cases = [
+    ('author filter', load_page(filters={'author': 'Author 42'})),
+    ('price range', load_page(sort='price', filters={'min_price': 10.0, 'max_price': 10.5})),
+    ('author and price range', load_page(sort='price', filters={'author': 'Author 42', 'min_price': 10.0,
+                                                                'max_price': 60.0})),
+    ('keyset page by price', load_page(sort='price', after_id=rows_count // 2)),
+    ('keyset page by id', load_page(after_id=rows_count // 2)),
+    ('full-text search, common word', lambda: service.load_book_search_results('river', 20)),
+    ('full-text search, two words', lambda: service.load_book_search_results('silver storm', 20)),
+    ('full-text search, prefix', lambda: service.load_book_search_results('isl', 20)),
+]
+with service.app.app_context():
+    for name, query in cases:
+        print(f'{name:32} {time_call(query):8.2f} ms')
@@ -0,0 +1,106 @@
+import atexit
+import contextlib
+import http.client
+import importlib
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# The service modules live at the top of the repository
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+
+# Import the bookstore service with the local cache and its databases and logs in a new temporary directory,
+# so the benchmarks never touch the data of the project
+def load_service(**environ):
+    data_dir = tempfile.mkdtemp(prefix='bookstore-bench-')
+    # Registered before the service is imported, so it runs after the service has flushed its data on exit
+    atexit.register(shutil.rmtree, data_dir, ignore_errors=True)
+    os.makedirs(os.path.join(data_dir, 'replicas'))
+    os.environ['BOOKSTORE_DATA_DIR'] = data_dir
+    os.environ.setdefault('CACHE_BACKEND', 'local')
+    os.environ.setdefault('REPLICATION_MODE', 'sync')
+    # No replica servers run during the benchmarks
+    os.environ.setdefault('CUSTOMER_REPLICA_URLS', ','.join(f'http://127.0.0.1:9/{i}' for i in range(1, 5)))
+    os.environ.update(environ)
+    service = importlib.import_module('bookstore_service')
+    # The service logs every request, which would be measured along with it
+    logging.disable(logging.CRITICAL)
+    return service
+
+
+# Silence the prints of the service while the code under measurement runs
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+# Median time of a call in milliseconds, over repeat runs
+def time_call(function, repeat=20):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+
+# Keep-alive HTTP load: clients threads each send GET path for duration seconds to the ports in turn.
+# Returns the requests per second, the median and 99th percentile latency in milliseconds and the errors.
+def run_load(host, ports, path, clients, duration):
+    latencies = []
+    errors = [0]
+    stop = time.monotonic() + duration
+
+    def client(port):
+        connection = http.client.HTTPConnection(host, port, timeout=30)
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors[0] += 1
+                if response.will_close:
+                    connection.close()
+                    connection = http.client.HTTPConnection(host, port, timeout=30)
+            except Exception:
+                errors[0] += 1
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=30)
+            latencies.append(time.perf_counter() - started)
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(ports[i % len(ports)],)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    if not latencies:
+        return 0, 0, 0, errors[0]
+    return (len(latencies) / duration, latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000, errors[0])
+
+
+# Wait until a server accepts connections on the port
+def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=1)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Nothing is listening on {host}:{port}')
@@ -0,0 +1,61 @@
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+# Importing common puts the service modules on the path
+from common import time_call
+from customer_store import CustomerStore
+from replication_log import ChangeLog, InterProcessLock, read_snapshot_seq
+
+# Cost of incrementing orders_count of every customer, as each two-phase commit book insert does:
+#   python bench/customers_increment.py [customers]
+customers_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+data_dir = tempfile.mkdtemp(prefix='bookstore-bench-')
+# Registered before the store, so it runs after the store has flushed on exit
+atexit.register(shutil.rmtree, data_dir, ignore_errors=True)
+path = os.path.join(data_dir, 'customers.json')
+documents = {str(doc_id): {'name': f'Customer {doc_id}', 'email': f'customer{doc_id}@example.com', 'orders_count': 0}
+             for doc_id in range(1, customers_count + 1)}
+with open(path, 'w') as f:
+    json.dump({'customers': documents}, f)
+
+
+def timed(function):
+    started = time.perf_counter()
+    function()
+    return (time.perf_counter() - started) * 1000
+
+
+# What an increment cost before the store: load the file, change every document and write the file back
+def load_loop_and_rewrite():
+    with open(path) as f:
+        data = json.load(f)
+    for document in data['customers'].values():
+        document['orders_count'] += 1
+    with open(path + '.old', 'w') as f:
+        json.dump(data, f)
+
+
+# Changing every document in memory, without any file access
+def loop_in_memory():
+    for document in documents.values():
+        document['orders_count'] += 1
+
+
+print(f'{customers_count} customers')
+print(f'{"load, loop and rewrite the file":36} {timed(load_loop_and_rewrite):10.2f} ms')
+print(f'{"loop over the documents in memory":36} {time_call(loop_in_memory, repeat=5):10.2f} ms')
+
+change_log = ChangeLog(os.path.join(data_dir, 'customers_changes.log'),
+                       compacted_seq=lambda: read_snapshot_seq(path, 0))
+store = CustomerStore(path, change_log, InterProcessLock(path + '.lock'), compact_every=10 ** 9)
+# Includes the fsynced append of the entry to the change log
+increment = time_call(lambda: store.increment_all('orders_count'), repeat=100)
+print(f'{"column increment":36} {increment:10.2f} ms')
+print(f'{"flush of customers.json":36} {timed(store.compact):10.2f} ms')
+column = store.counters['orders_count']
+print(f'{"size of the column":36} {len(column) * column.itemsize / 2 ** 20:10.2f} MiB')
@@ -0,0 +1,49 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from common import repo_dir, run_load, wait_for_port
+
+# Load test of the replica servers: starts replication.py, either of the working tree or of a git revision, on a
+# copy of customers.json, and sends GET /customers from keep-alive clients spread over the replica ports.
+#   python bench/replica_load.py              the replica servers of the working tree
+#   python bench/replica_load.py c12ab32~1    the replica servers before they were moved to waitress
+# BENCH_CLIENTS (default 16) and BENCH_DURATION (default 5 seconds) set the size of the load.
+revision = sys.argv[1] if len(sys.argv) > 1 else None
+clients = int(os.environ.get('BENCH_CLIENTS', 16))
+duration = float(os.environ.get('BENCH_DURATION', 5))
+host = '127.0.0.1'
+ports = [5071, 5072, 5073, 5074]
+
+work_dir = tempfile.mkdtemp(prefix='bookstore-bench-')
+environ = dict(os.environ)
+if revision:
+    # Older revisions keep their data next to replication.py, so they run from an export of the revision
+    archive = subprocess.run(['git', 'archive', revision], cwd=repo_dir, check=True, capture_output=True).stdout
+    subprocess.run(['tar', '-x', '-C', work_dir], input=archive, check=True)
+    environ.pop('BOOKSTORE_DATA_DIR', None)
+    server_dir = work_dir
+else:
+    shutil.copy(os.path.join(repo_dir, 'customers.json'), work_dir)
+    environ['BOOKSTORE_DATA_DIR'] = work_dir
+    server_dir = repo_dir
+
+# The servers run in a session of their own so that every process they start is stopped with them
+server = subprocess.Popen([sys.executable, 'replication.py'], cwd=server_dir, env=environ,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+try:
+    for port in ports:
+        wait_for_port(host, port)
+    run_load(host, ports, '/customers', clients, 1)
+    rps, p50, p99, errors = run_load(host, ports, '/customers', clients, duration)
+    print(f'{revision or "working tree"}: {clients} clients on ports {ports[0]}-{ports[-1]} for {duration:g} s: '
+          f'{rps:.0f} req/s, p50 {p50:.1f} ms, p99 {p99:.1f} ms, {errors} errors')
+finally:
+    os.killpg(server.pid, signal.SIGTERM)
+    server.wait()
+    # The servers may still be writing their replicas while they stop
+    time.sleep(0.5)
+    shutil.rmtree(work_dir, ignore_errors=True)
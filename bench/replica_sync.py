@@ -0,0 +1,46 @@
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+# Importing common puts the service modules on the path
+from common import time_call
+from customer_store import CustomerStore
+from replication_log import ChangeLog, InterProcessLock, ReplicaSync, read_snapshot_seq
+
+# Cost of bringing the four replicas up to date after one customer write, against copying the whole file to them:
+#   python bench/replica_sync.py [customers]
+customers_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+data_dir = tempfile.mkdtemp(prefix='bookstore-bench-')
+# Registered before the store, so it runs after the store has flushed on exit
+atexit.register(shutil.rmtree, data_dir, ignore_errors=True)
+path = os.path.join(data_dir, 'customers.json')
+with open(path, 'w') as f:
+    json.dump({'customers': {str(doc_id): {'name': f'Customer {doc_id}', 'email': f'customer{doc_id}@example.com',
+                                           'orders_count': 0} for doc_id in range(1, customers_count + 1)}}, f)
+
+change_log = ChangeLog(os.path.join(data_dir, 'customers_changes.log'),
+                       compacted_seq=lambda: read_snapshot_seq(path, 0))
+write_lock = InterProcessLock(path + '.lock')
+store = CustomerStore(path, change_log, write_lock, compact_every=10 ** 9)
+replica_paths = [os.path.join(data_dir, f'customers_replica{replica_id}.json') for replica_id in range(1, 5)]
+replica_sync = ReplicaSync(path, replica_paths, change_log, write_lock)
+replica_sync.sync_all()
+
+
+def copy_to_replicas():
+    for replica_path in replica_paths:
+        shutil.copy(path, replica_path + '.copy')
+
+
+def update_and_sync():
+    store.update(1, {'name': 'Renamed'})
+    replica_sync.sync_all()
+
+
+print(f'{customers_count} customers, {len(replica_paths)} replicas')
+print(f'{"copy of the file to every replica":36} {time_call(copy_to_replicas, repeat=5):10.2f} ms')
+# Includes the fsynced append of the update to the change log
+print(f'{"update synced to every replica":36} {time_call(update_and_sync, repeat=100):10.2f} ms')
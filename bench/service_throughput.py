@@ -0,0 +1,48 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from common import repo_dir, run_load, wait_for_port
+
+# Throughput of the bookstore service under the Flask development server and under gunicorn:
+#   python bench/service_throughput.py dev        python bookstore_service.py
+#   python bench/service_throughput.py gunicorn   gunicorn bookstore_service:app with gunicorn.conf.py
+# The workers and threads of gunicorn are set as usual with SERVICE_WORKERS and SERVICE_THREADS (more than one
+# worker needs CACHE_BACKEND=redis or two-tier and the Redis cluster). BENCH_CLIENTS (default 16) and
+# BENCH_DURATION (default 5 seconds) set the size of the load sent to each endpoint.
+server_kind = sys.argv[1] if len(sys.argv) > 1 else 'gunicorn'
+clients = int(os.environ.get('BENCH_CLIENTS', 16))
+duration = float(os.environ.get('BENCH_DURATION', 5))
+host = '127.0.0.1'
+port = 5050
+paths = ['/books', '/books?limit=50', '/customers']
+
+commands = {
+    'dev': [sys.executable, 'bookstore_service.py'],
+    'gunicorn': [sys.executable, '-m', 'gunicorn', 'bookstore_service:app'],
+}
+if server_kind not in commands:
+    sys.exit(f'Unknown server {server_kind}; expected one of: {", ".join(commands)}')
+
+data_dir = tempfile.mkdtemp(prefix='bookstore-bench-')
+os.makedirs(os.path.join(data_dir, 'replicas'))
+environ = dict(os.environ, BOOKSTORE_DATA_DIR=data_dir, SERVICE_BIND=f'{host}:{port}')
+# Customer reads are answered by the primary; no replica servers run during the benchmark
+environ.setdefault('CUSTOMER_REPLICA_URLS', ','.join(f'http://127.0.0.1:9/{i}' for i in range(1, 5)))
+
+# The server runs in a session of its own so that every process it starts is stopped with it
+server = subprocess.Popen(commands[server_kind], cwd=repo_dir, env=environ,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+try:
+    wait_for_port(host, port)
+    for path in paths:
+        run_load(host, [port], path, clients, 1)
+        rps, p50, p99, errors = run_load(host, [port], path, clients, duration)
+        print(f'{server_kind} {path:18} {clients} clients for {duration:g} s: {rps:.0f} req/s, '
+              f'p50 {p50:.1f} ms, p99 {p99:.1f} ms, {errors} errors')
+finally:
+    os.killpg(server.pid, signal.SIGTERM)
+    server.wait()
+    shutil.rmtree(data_dir, ignore_errors=True)
@@ -1,43 +1,141 @@
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
-from tinydb import TinyDB, Query
+from sqlalchemy import insert, text, tuple_, update
 import os
-import shutil
+import glob
 import json
 import logging
-import hashlib
-from rediscluster import RedisCluster
+from replication_log import ChangeLog, InterProcessLock, ReplicaSync, ReplicationWorker, read_snapshot_seq
+from read_router import CustomerReadRouter
+from customer_store import CustomerStore
+from two_phase_commit import (CounterParticipant, SQLInsertParticipant, TransactionAborted, TransactionLog,
+                              TwoPhaseCommitCoordinator)
+from streaming import representation_etag, requested_stream_mode, streaming_response, vary_on_accept
+from cache_utils import (CachedCollection, KeysetPageIndex, ReadThroughCache, build_payload, is_not_modified,
+                         not_modified_response, payload_response)
+from cache_backends import DistributedCache, RedisCacheBackend
+from redis_cache import RedisClusterCache
 
 app = Flask(__name__)
 
 databases_created = False
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
+# Directory of the databases, logs and replicas: the directory of this file unless BOOKSTORE_DATA_DIR is set
+data_dir = os.environ.get('BOOKSTORE_DATA_DIR', script_dir)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(script_dir, 'bookstore.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(data_dir, 'bookstore.db')
 db = SQLAlchemy(app)
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-source_tinydb_db_path = os.path.join(script_dir, 'customers.json')
-replicas_dir = os.path.join(script_dir, 'replicas')
+source_tinydb_db_path = os.path.join(data_dir, 'customers.json')
+replicas_dir = os.path.join(data_dir, 'replicas')
 
 class Book(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(100), nullable=False)
-    author = db.Column(db.String(100), nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    title = db.Column(db.String(100), nullable=False, index=True)
+    author = db.Column(db.String(100), nullable=False, index=True)
+    price = db.Column(db.Float, nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
 
-db_customers = TinyDB(os.path.join(script_dir, 'customers.json'))
-customers_table = db_customers.table('customers')
+    # Serves filtering by author combined with a price range or sorting by price
+    __table_args__ = (db.Index('ix_book_author_price', 'author', 'price'),)
+
+# SQLite FTS5 index over book titles and authors, kept in sync with the book table by triggers
+book_fts_statements = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5(title, author, content='book', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_insert AFTER INSERT ON book BEGIN
+        INSERT INTO book_fts(rowid, title, author) VALUES (new.id, new.title, new.author);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_delete AFTER DELETE ON book BEGIN
+        INSERT INTO book_fts(book_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_update AFTER UPDATE ON book BEGIN
+        INSERT INTO book_fts(book_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+        INSERT INTO book_fts(rowid, title, author) VALUES (new.id, new.title, new.author);
+    END""",
+]
+fts_enabled = False
+
+# Customer writes and their change log entries happen under this lock, shared with the replicator process,
+# so replica snapshots are consistent
+customers_write_lock = InterProcessLock(source_tinydb_db_path + '.lock')
+# The change log is the write-ahead log of customers.json, so only entries compacted into the file are ever dropped
+customers_change_log = ChangeLog(os.path.join(data_dir, 'customers_changes.log'),
+                                 compacted_seq=lambda: read_snapshot_seq(source_tinydb_db_path, 0))
+# Customers live in memory; writes are appended to the change log and customers.json is written back from it
+# every CUSTOMERS_COMPACT_EVERY writes and on shutdown. The log already makes every write durable, so rewriting the
+# whole file on a timer as well, every CUSTOMERS_FLUSH_INTERVAL seconds, is off unless set.
+customers_store = CustomerStore(source_tinydb_db_path, customers_change_log, customers_write_lock,
+                                compact_every=int(os.environ.get('CUSTOMERS_COMPACT_EVERY', 1000)),
+                                flush_interval=float(os.environ.get('CUSTOMERS_FLUSH_INTERVAL', 0)) or None)
+replica_db_paths = [os.path.join(replicas_dir, f'customers_replica{replica_id}.json') for replica_id in range(1, 5)]
+replica_sync = ReplicaSync(source_tinydb_db_path, replica_db_paths, customers_change_log, customers_write_lock)
+# Replication runs "sync", "async" (background workers) or "quorum" (wait for REPLICATION_QUORUM replicas)
+replication_worker = ReplicationWorker(replica_sync, mode=os.environ.get('REPLICATION_MODE', 'async'),
+                                       quorum=int(os.environ.get('REPLICATION_QUORUM', 2)),
+                                       timeout=float(os.environ.get('REPLICATION_TIMEOUT', 5)))
+# Customer reads are spread over the primary and the replica servers started by replication.py
+replica_urls = os.environ.get('CUSTOMER_REPLICA_URLS', ','.join(
+    f'http://localhost:{5070 + replica_id}/customers' for replica_id in range(1, len(replica_db_paths) + 1))).split(',')
+customer_read_router = CustomerReadRouter(customers_store.all, list(zip(replica_urls, replica_db_paths)), replica_sync,
+                                          health_interval=float(os.environ.get('REPLICA_HEALTH_INTERVAL', 5)),
+                                          timeout=float(os.environ.get('REPLICA_READ_TIMEOUT', 2)))
+# Every process, e.g. each worker of the server, commits through a transaction log of its own
+def open_transaction_log():
+    transaction_log = TransactionLog(os.path.join(data_dir, f'transactions-{os.getpid()}.log'))
+    transaction_log.claim()
+    return transaction_log
+
+# Transaction logs left by processes that are gone, claimed for recovery by this one
+def orphaned_transaction_logs():
+    paths = sorted(glob.glob(os.path.join(data_dir, 'transactions*.log')))
+    transaction_logs = [TransactionLog(path) for path in paths if path != two_phase_commit.log.path]
+    return [transaction_log for transaction_log in transaction_logs if transaction_log.claim()]
+
+# Books with a customer order count update go through two-phase commit; concurrent requests are committed
+# in batches of up to TWO_PHASE_COMMIT_MAX_BATCH that share their fsyncs
+two_phase_commit = TwoPhaseCommitCoordinator(
+    open_transaction_log(),
+    [SQLInsertParticipant('books', lambda: db.engine, Book.__table__),
+     CounterParticipant('customers', customers_store, 'orders_count')],
+    max_batch=int(os.environ.get('TWO_PHASE_COMMIT_MAX_BATCH', 100)))
+# Keeps the processes of the service from creating the databases or recovering transactions at the same time
+databases_lock = InterProcessLock(os.path.join(data_dir, 'bookstore.db.lock'))
+# Change log position returned by customer writes; clients send it back to read their own writes
+customers_version_header = 'X-Customers-Version'
+
+# Create the full-text index of books, filling it from the existing rows the first time
+def create_book_fts():
+    global fts_enabled
+    try:
+        with db.engine.begin() as connection:
+            exists = connection.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'book_fts'")).first()
+            for statement in book_fts_statements:
+                connection.execute(text(statement))
+            if not exists:
+                connection.execute(text("INSERT INTO book_fts(book_fts) VALUES ('rebuild')"))
+        fts_enabled = True
+    except Exception as e:
+        print(f'Full-text search is not available: {str(e)}')
+        logger.error(f'Full-text search is not available: {str(e)}')
 
+# Create the databases if needed and recover what a crash left unfinished. Server workers each run this once
+# started, one at a time, rather than the server before forking them, so that it holds no thread or lock then.
 def create_databases():
     global databases_created
-    if not databases_created:
+    if databases_created:
+        return
+    with databases_lock:
         with app.app_context():
             db.create_all()
+            # create_all does not add new indexes to an existing table
+            for index in Book.__table__.indexes:
+                index.create(bind=db.engine, checkfirst=True)
+            create_book_fts()
             if not Book.query.first():
                 initial_books = [
                     {'title': 'The Great Gatsby', 'author': 'F. Scott Fitzgerald', 'price': 10.99, 'quantity': 5},
@@ -48,102 +146,401 @@ def create_databases():
                     db.session.add(new_book)
                 db.session.commit()
 
-        if not customers_table.all():
-            customers_table.insert_multiple([
+        if not len(customers_store):
+            customers_store.insert_multiple([
                 {'name': 'John Doe', 'email': 'john@example.com', 'orders_count': 0},
                 {'name': 'Alice Smith', 'email': 'alice@example.com', 'orders_count': 0}
             ])
 
+        # Finish the two-phase commits that were decided before the service, or one of its workers, stopped
+        with app.app_context():
+            recovered = two_phase_commit.recover(orphaned_transaction_logs())
+        if recovered:
+            print(f'Recovered {recovered} committed transactions.')
+            logger.info(f'Recovered {recovered} committed transactions.')
+
         databases_created = True
 
-# Cache node containing data
-class CacheNode:
-    def __init__(self, node_id):
-        self.node_id = node_id
-        self.data = {}
-
-# Consistent hashing logic to distribute keys across nodes
-class ConsistentHashing:
-    def __init__(self, num_nodes):
-        # Create a list of cache nodes
-        self.nodes = [CacheNode(node_id) for node_id in range(num_nodes)]
-
-    # Get the node responsible for a given key based on consistent hashing
-    def get_node(self, key):
-        # Calculate the hash of the key
-        hash_value = hashlib.sha1(key.encode()).hexdigest()
-        # Map the hash to a node index
-        node_index = int(hash_value, 16) % len(self.nodes)
-        # Return the corresponding node
-        return self.nodes[node_index]
-
-# Distributed cache with sharding and consistent hashing
-class DistributedCache:
-    def __init__(self, num_shards, num_replicas):
-        self.num_shards = num_shards
-        self.num_replicas = num_replicas
-        # Create a list of sharding instances
-        self.shards = [ConsistentHashing(num_replicas) for _ in range(num_shards)]
-
-    # Get the value associated with a key from the cache
-    def get(self, key):
-        # Determine the shard index based on the hash of the key
-        shard_index = hash(key) % self.num_shards
-        # Get the node responsible for the key within the shard
-        node = self.shards[shard_index].get_node(key)
-        # Return the value associated with the key in the node's data
-        return node.data.get(key)
-
-    # Set a key-value pair in the cache
-    def set(self, key, value):
-        # Determine the shard index based on the hash of the key
-        shard_index = hash(key) % self.num_shards
-        # Get the node responsible for the key within the shard
-        node = self.shards[shard_index].get_node(key)
-        # Set the key-value pair in the node's data
-        node.data[key] = value
-
-    # Clear the cache for a specific key
-    def clear(self, key):
-        # Determine the shard index based on the hash of the key
-        shard_index = hash(key) % self.num_shards
-        # Get the node responsible for the key within the shard
-        node = self.shards[shard_index].get_node(key)
-        # Remove the key from the node's data if it exists
-        if key in node.data:
-            del node.data[key]
-
-    # Check if a cache with a specific key exists
-    def exists(self, key):
-        # Determine the shard index based on the hash of the key
-        shard_index = hash(key) % self.num_shards
-        # Get the node responsible for the key within the shard
-        node = self.shards[shard_index].get_node(key)
-        # Return True if the key exists in the node's data, False otherwise
-        return key in node.data
-
-cache = DistributedCache(num_shards=4, num_replicas=3)
+# Cache budget per node and default TTL in seconds, configurable through the environment (0 disables a limit)
+cache_max_entries = int(os.environ.get('CACHE_MAX_ENTRIES', 1024)) or None
+cache_max_bytes = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024)) or None
+cache_default_ttl = float(os.environ.get('CACHE_DEFAULT_TTL', 300)) or None
+
+# Cache backend: "local" (sharded cache in the process), "redis" (the Redis cluster at REDIS_NODES) or "two-tier"
+# (a sharded near-cache in the process in front of the Redis cluster, kept coherent by Redis invalidations)
+cache_backend = os.environ.get('CACHE_BACKEND', 'local')
+redis_nodes = os.environ.get('REDIS_NODES', ','.join(f'localhost:{port}' for port in range(7000, 7006)))
+
+def create_cache(backend):
+    if backend == 'local':
+        return DistributedCache(num_shards=4, num_replicas=3, max_entries=cache_max_entries,
+                                max_bytes=cache_max_bytes, default_ttl=cache_default_ttl)
+    if backend not in ('redis', 'two-tier'):
+        raise ValueError(f'Unknown cache backend: {backend}')
+    near_cache = None
+    if backend == 'two-tier':
+        # A small single-node cache of the hottest entries; its budget is its own, not the per-node budget above
+        near_cache = DistributedCache(num_shards=1, num_replicas=1,
+                                      max_entries=int(os.environ.get('NEAR_CACHE_ENTRIES', 256)) or None,
+                                      max_bytes=int(os.environ.get('NEAR_CACHE_MAX_BYTES', 16 * 1024 * 1024)) or None,
+                                      default_ttl=float(os.environ.get('NEAR_CACHE_TTL', 5)) or None)
+    startup_nodes = [{'host': host, 'port': port}
+                     for host, port in (node.rsplit(':', 1) for node in redis_nodes.split(','))]
+    # Connections per Redis node, how long a request waits for a free one and the socket timeout, in seconds
+    redis_cache = RedisClusterCache(startup_nodes,
+                                    max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', 64)),
+                                    pool_timeout=float(os.environ.get('REDIS_POOL_TIMEOUT', 5)),
+                                    socket_timeout=float(os.environ.get('REDIS_SOCKET_TIMEOUT', 1)),
+                                    near_cache=near_cache)
+    return RedisCacheBackend(redis_cache, default_ttl=cache_default_ttl)
+
+cache = create_cache(cache_backend)
+# Cached collections are rebuilt in the background of the traffic once stale: after a write, after CACHE_SOFT_TTL
+# seconds, or a little earlier at random weighted by CACHE_EARLY_REFRESH_BETA. One reader rebuilds them under a
+# lock held for at most CACHE_LOCK_TTL seconds while the others are served the previous version.
+read_through = ReadThroughCache(cache.get, cache.set, cache.acquire_lock, cache.release_lock,
+                                soft_ttl=float(os.environ.get('CACHE_SOFT_TTL', 60)) or None,
+                                early_refresh_beta=float(os.environ.get('CACHE_EARLY_REFRESH_BETA', 1)),
+                                lock_ttl=float(os.environ.get('CACHE_LOCK_TTL', 10)))
+# Collection versions bumped by every write, used as ETags of the cached collections; shared between
+# processes when the backend is, i.e. kept in Redis by the redis and two-tier backends
+versions = cache.versions
+# Books cached whole and one by one under book:<id>; writes patch the cached books instead of dropping them
+books_collection = CachedCollection('books', 'book', cache, read_through, versions)
+# Bounds of the cached pages of GET /books, used to invalidate only the pages a write touches
+book_pages = KeysetPageIndex(cache.delete)
+
+# Give a forked process, e.g. a worker of a pre-forking server started from a preloaded app, its own database
+# connections, cache and transaction log instead of sharing those of its parent
+def reset_after_fork():
+    with app.app_context():
+        db.engine.dispose(close=False)
+    cache.after_fork()
+    two_phase_commit.log = open_transaction_log()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+# Fields a book can be projected to, and the indexed columns GET /books can be sorted on
+book_fields = ('id', 'title', 'author', 'price', 'quantity')
+# JSON types accepted for each field of a book in a batch
+book_field_types = {'id': int, 'title': str, 'author': str, 'price': (int, float), 'quantity': int}
+book_sort_columns = ('id', 'title', 'author', 'price')
+books_page_args = ('limit', 'after_id', 'fields', 'sort', 'order', 'author', 'title', 'min_price', 'max_price')
+max_books_page_limit = 1000
+max_books_batch_size = 10000
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    print('Received request to fetch cache statistics.')
+    logger.info('Received request to fetch cache statistics.')
+    return jsonify(dict(cache.stats(), read_through=read_through.stats(), books=books_collection.stats()))
+
+# Write changed books through to their cache entries and patch them into the cached books, which are otherwise
+# left stale for a single reader to rebuild. Returns the books as stored, read while their entries are locked.
+def write_through_books(book_ids):
+    books, patched = books_collection.write_through(book_ids, load_books_by_id)
+    if patched:
+        print('Books cache updated in place.')
+        logger.info('Books cache updated in place.')
+    else:
+        print('Books cache marked stale.')
+        logger.info('Books cache marked stale.')
+    return books
+
+# Mark a cached collection stale after a write. It is not deleted, so that readers keep being served the previous
+# version while a single reader rebuilds it
+def mark_collection_stale(name):
+    versions.bump(name)
+    print(f'{name.capitalize()} cache marked stale.')
+    logger.info(f'{name.capitalize()} cache marked stale.')
+
+# Bring the replicas up to date with the logged customer changes, according to the replication mode
+def replicate_customers_db():
+    if replication_worker.replicate():
+        print(f'Customer changes handed to replication ({replication_worker.mode} mode).')
+        logger.info(f'Customer changes handed to replication ({replication_worker.mode} mode).')
+    else:
+        print(f'Replication quorum of {replication_worker.quorum} replicas not reached in time.')
+        logger.warning(f'Replication quorum of {replication_worker.quorum} replicas not reached in time.')
+
+@app.route('/replication/status', methods=['GET'])
+def get_replication_status():
+    print('Received request to fetch replication status.')
+    logger.info('Received request to fetch replication status.')
+    return jsonify(dict(replication_worker.lag(), read_router=customer_read_router.status()))
+
+# Lowest change log position a customers read must reflect: the session's last write, if it sent its token
+def requested_customers_version():
+    token = request.headers.get(customers_version_header) or request.cookies.get('customers_version')
+    try:
+        return int(token) if token else 0
+    except ValueError:
+        return 0
+
+# Attach the change log position of a customer write to its response as the session version token
+def with_customers_version(response):
+    seq = customers_change_log.head_seq
+    response.headers[customers_version_header] = str(seq)
+    response.set_cookie('customers_version', str(seq), httponly=True)
+    return response
+
+# Read all customers from the primary or a replica that is at least as recent as the cache version being filled
+def load_customers():
+    customers_change_log.reload()
+    min_seq = max(customers_change_log.head_seq, requested_customers_version())
+    customers, source = customer_read_router.read(min_seq)
+    print(f'Customers read from {source}.')
+    logger.info(f'Customers read from {source}.')
+    return customers
+
+# Convert a book into the dictionary returned by the API
+def book_to_dict(book):
+    return {'id': book.id, 'title': book.title, 'author': book.author, 'price': book.price, 'quantity': book.quantity}
+
+# Load all books from the database in the shape returned by GET /books, in the id order the cached books keep
+def load_books():
+    return [book_to_dict(book) for book in Book.query.order_by(Book.id)]
+
+# Load one book in the shape returned by GET /books
+def load_book(book_id):
+    book = db.session.get(Book, book_id)
+    if book is None:
+        raise LookupError(f'Book {book_id} not found.')
+    return book_to_dict(book)
+
+# Load books by id after a write, as stored by the database
+def load_books_by_id(book_ids):
+    query = db.session.query(Book.id, Book.title, Book.author, Book.price, Book.quantity)
+    return [row._asdict() for row in query.filter(Book.id.in_(book_ids)).order_by(Book.id)]
+
+# Iterate over all books from a database cursor, fetching rows in batches instead of loading them all
+def iter_books(batch_size=1000):
+    query = db.session.query(Book.id, Book.title, Book.author, Book.price, Book.quantity).order_by(Book.id)
+    for row in query.yield_per(batch_size):
+        yield row._asdict()
+
+# Number of books asked for with ?limit=, between 1 and max_books_page_limit, or default if not given
+def parse_limit(args, default=None):
+    if 'limit' not in args:
+        return default
+    limit = args.get('limit', type=int)
+    if limit is None or not 1 <= limit <= max_books_page_limit:
+        raise ValueError(f'limit must be an integer between 1 and {max_books_page_limit}')
+    return limit
+
+# Parse the pagination, projection and sorting parameters of GET /books
+def parse_books_page_args(args):
+    limit = parse_limit(args)
+    after_id = args.get('after_id', type=int)
+    if 'after_id' in args and after_id is None:
+        raise ValueError('after_id must be an integer')
+    fields = book_fields
+    if args.get('fields'):
+        fields = tuple(sorted(set(args['fields'].split(','))))
+        unknown = [field for field in fields if field not in book_fields]
+        if unknown:
+            raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+    sort = args.get('sort', 'id')
+    if sort not in book_sort_columns:
+        raise ValueError(f'sort must be one of: {", ".join(book_sort_columns)}')
+    order = args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError('order must be asc or desc')
+    filters = {}
+    for name in ('author', 'title'):
+        if name in args:
+            filters[name] = args[name]
+    for name in ('min_price', 'max_price'):
+        if name in args:
+            value = args.get(name, type=float)
+            if value is None:
+                raise ValueError(f'{name} must be a number')
+            filters[name] = value
+    return {'limit': limit, 'after_id': after_id, 'fields': fields, 'sort': sort, 'descending': order == 'desc',
+            'filters': filters}
+
+# Check whether a book matches the filters of GET /books
+def book_matches_filters(book, filters):
+    if 'author' in filters and book['author'] != filters['author']:
+        return False
+    if 'title' in filters and book['title'] != filters['title']:
+        return False
+    if 'min_price' in filters and book['price'] < filters['min_price']:
+        return False
+    return 'max_price' not in filters or book['price'] <= filters['max_price']
+
+# Load one keyset page of books: the rows sorted after the after_id book, reading only the needed columns.
+# Equality filters on author and title and the price range are answered from the secondary indexes.
+def load_books_page(limit, after_id, fields, sort, descending, filters):
+    sort_column = getattr(Book, sort)
+    selected = sorted(set(fields) | {'id', sort})
+    query = db.session.query(*[getattr(Book, field) for field in selected])
+    if 'author' in filters:
+        query = query.filter(Book.author == filters['author'])
+    if 'title' in filters:
+        query = query.filter(Book.title == filters['title'])
+    if 'min_price' in filters:
+        query = query.filter(Book.price >= filters['min_price'])
+    if 'max_price' in filters:
+        query = query.filter(Book.price <= filters['max_price'])
+
+    lower_key = None
+    if after_id is not None:
+        cursor_value = db.session.query(sort_column).filter(Book.id == after_id).scalar()
+        if cursor_value is None:
+            raise LookupError(f'Book {after_id} not found.')
+        lower_key = (cursor_value, after_id)
+        if sort == 'id':
+            query = query.filter(Book.id < after_id if descending else Book.id > after_id)
+        # Row-value comparisons let SQLite seek straight to the cursor in the index on the sort column
+        elif descending:
+            query = query.filter(tuple_(sort_column, Book.id) < tuple_(cursor_value, after_id))
+        else:
+            query = query.filter(tuple_(sort_column, Book.id) > tuple_(cursor_value, after_id))
+
+    # The id breaks ties so that every book has a unique position in the order
+    order_by = [sort_column] if sort == 'id' else [sort_column, Book.id]
+    query = query.order_by(*[column.desc() if descending else column for column in order_by])
+    if limit is not None:
+        query = query.limit(limit)
+    rows = [row._asdict() for row in query]
+
+    # A full page ends at its last row; a shorter one reaches the end of the collection
+    upper_key = None
+    if limit is not None and len(rows) == limit:
+        upper_key = (rows[-1][sort], rows[-1]['id'])
+    books = [{field: row[field] for field in fields} for row in rows]
+    return books, lower_key, upper_key
+
+# Serve a page of GET /books from its own cache entry, loading it once for concurrent misses
+def get_books_page(params):
+    filters = params['filters']
+    cache_key = 'books:page:{sort}:{order}:{after_id}:{limit}:{fields}:{filters}'.format(
+        sort=params['sort'], order='desc' if params['descending'] else 'asc', after_id=params['after_id'],
+        limit=params['limit'], fields=','.join(params['fields']), filters=json.dumps(filters, sort_keys=True))
+    # The page index only sees the writes of this process, so pages of a shared cache are keyed by the
+    # collection version instead, which every write of any process moves on
+    if cache.shared:
+        cache_key = cache.versioned_key('books', cache_key)
+
+    def fill():
+        payload = cache.get(cache_key)
+        if payload:
+            return payload
+        start_seq = book_pages.seq
+        books, lower_key, upper_key = load_books_page(**params)
+        if params['limit'] is None:
+            payload = build_payload(books)
+        else:
+            next_after_id = upper_key[1] if upper_key is not None else None
+            payload = build_payload({'books': books, 'next_after_id': next_after_id})
+        book_pages.register(cache_key, params['sort'], params['descending'], params['after_id'], lower_key, upper_key,
+                            start_seq, lambda: cache.set(cache_key, payload),
+                            lambda book: book_matches_filters(book, filters))
+        return payload
+
+    payload = cache.get(cache_key)
+    from_cache = payload is not None
+    if not from_cache:
+        payload = read_through.single_flight.do(cache_key, fill)
+    return payload, from_cache
+
+# Drop only the cached pages of GET /books that contain the changed book
+def invalidate_book_pages(old_row, new_row):
+    cache.delete(*book_pages.invalidate_row(old_row, new_row))
 
 @app.route('/books', methods=['GET'])
 def get_books():
     print('Received request to fetch books.')
     logger.info('Received request to fetch books.')
 
-    books = Book.query.all()
-    output = [{'id': book.id, 'title': book.title, 'author': book.author, 'price': book.price, 'quantity': book.quantity} for book in books]
-
-    cached_books = cache.get('books')
-    if cached_books:
+    # Paginated, projected or sorted requests are cached page by page
+    if any(arg in request.args for arg in books_page_args):
+        try:
+            payload, from_cache = get_books_page(parse_books_page_args(request.args))
+        except ValueError as e:
+            print(f'Invalid books query: {str(e)}')
+            logger.error(f'Invalid books query: {str(e)}')
+            return jsonify({'error': str(e)}), 400
+        except LookupError as e:
+            print(str(e))
+            logger.error(str(e))
+            return jsonify({'error': str(e)}), 404
+
+        if from_cache:
+            print('Retrieving books page from the cache.')
+            logger.info('Retrieving books page from the cache.')
+        else:
+            print('Successfully added books page to the cache.')
+            logger.info('Successfully added books page to the cache.')
+        if is_not_modified(request, payload.etag):
+            return not_modified_response(payload.etag)
+        return payload_response(payload)
+
+    # Answer polls of an unchanged collection with 304 without touching the cache or the database; each
+    # representation the client can ask for has an ETag of its own
+    stream_mode = requested_stream_mode(request)
+    etag = representation_etag(versions.etag('books'), stream_mode)
+    if is_not_modified(request, etag):
+        print('Books not modified since the last request.')
+        logger.info('Books not modified since the last request.')
+        return vary_on_accept(not_modified_response(etag))
+
+    # Large catalogues can be streamed from the database cursor instead of being built in memory
+    if stream_mode:
+        print('Streaming books from the database.')
+        logger.info('Streaming books from the database.')
+        return vary_on_accept(streaming_response(iter_books(), stream_mode, etag))
+
+    # The database is only queried on a cache miss, and only once for concurrent misses
+    payload, from_cache = books_collection.fetch(load_books)
+    if from_cache:
         print('Retrieving books from the cache.')
         logger.info('Retrieving books from the cache.')
-        return cached_books
-
-    # Add books to cache if they are not yet cached
-    cache.set('books', jsonify(output))
-    print('Successfully added books to the cache.')
-    logger.info('Successfully added books to the cache.')
-
-    return jsonify(output)
+    else:
+        print('Successfully added books to the cache.')
+        logger.info('Successfully added books to the cache.')
+
+    return vary_on_accept(payload_response(payload))
+
+# Turn free text into an FTS5 query matching every word as a prefix, so user input cannot break the query syntax
+def fts_query(search_text):
+    return ' '.join('"{}"*'.format(term.replace('"', '""')) for term in search_text.split())
+
+# Load the books whose title or author best match a full-text query
+def load_book_search_results(search_text, limit):
+    rows = db.session.execute(
+        text('SELECT book.id, book.title, book.author, book.price, book.quantity FROM book_fts '
+             'JOIN book ON book.id = book_fts.rowid WHERE book_fts MATCH :query ORDER BY rank LIMIT :limit'),
+        {'query': fts_query(search_text), 'limit': limit})
+    return [dict(row._mapping) for row in rows]
+
+@app.route('/books/search', methods=['GET'])
+def search_books():
+    print('Received request to search books.')
+    logger.info('Received request to search books.')
+    if not fts_enabled:
+        return jsonify({'error': 'Full-text search is not available.'}), 501
+
+    search_text = request.args.get('q', '').strip()
+    if not search_text:
+        return jsonify({'error': 'q must not be empty'}), 400
+    try:
+        limit = parse_limit(request.args, default=20)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Results are cached per query and rebuilt once the books collection version changes
+    etag = versions.etag('books')
+    payload, from_cache = read_through.fetch(f'books:search:{limit}:{search_text}',
+                                             lambda: load_book_search_results(search_text, limit), etag)
+    if from_cache:
+        print('Retrieving book search results from the cache.')
+        logger.info('Retrieving book search results from the cache.')
+    if is_not_modified(request, payload.etag):
+        return not_modified_response(payload.etag)
+    return payload_response(payload)
 
 @app.route('/books', methods=['POST'])
 def add_book():
@@ -154,26 +551,106 @@ def add_book():
     db.session.add(new_book)
     db.session.commit()
 
-    if cache.exists('books'):
-        cache.clear('books')
-        print('Books cache cleared.')
-        logger.info('Books cache cleared.')
+    invalidate_book_pages(None, write_through_books([new_book.id])[0])
 
     # Replicate the updated database data after a new book is added
-    for replica_id in range(1, 5):
-        replica_db_path = os.path.join(replicas_dir, f'customers_replica{replica_id}.json')
-        try:
-            shutil.copy(source_tinydb_db_path, replica_db_path)
-            print(f"Data replicated successfully in replica {replica_id}")
-            logger.info(f"Data replicated successfully in replica {replica_id}")
-        except Exception as e:
-            print(f"Failed to replicate data in replica {replica_id}: {str(e)}")
-            logger.error(f"Failed to replicate data in replica {replica_id}: {str(e)}")
+    replicate_customers_db()
 
     print('New book added successfully.')
     logger.info('New book added successfully.')
     return jsonify({'message': 'New book added successfully!'})
 
+# Validate the books of a batch request, returning the rows to write or raising ValueError
+def parse_books_batch(data, with_id):
+    if not isinstance(data, list) or not data:
+        raise ValueError('Expected a non-empty JSON array of books')
+    if len(data) > max_books_batch_size:
+        raise ValueError(f'A batch can contain at most {max_books_batch_size} books')
+    required = ('id', 'title', 'author', 'price', 'quantity') if with_id else ('title', 'author', 'price', 'quantity')
+    rows = []
+    for position, item in enumerate(data):
+        if not isinstance(item, dict) or any(key not in item for key in required):
+            raise ValueError(f'Book at position {position} must contain: {", ".join(required)}')
+        for key in required:
+            if not isinstance(item[key], book_field_types[key]) or isinstance(item[key], bool):
+                raise ValueError(f'Book at position {position} has an invalid {key}')
+        rows.append({key: item[key] for key in required})
+    return rows
+
+# Invalidate the cached books once for a whole batch of changed books, given their rows before the write
+def invalidate_books_batch(old_rows, book_ids):
+    # Checking every cached page against a large batch, or patching the cached books with it, costs more than
+    # rebuilding them
+    if len(book_ids) > 100:
+        mark_collection_stale('books')
+        cache.delete(*[books_collection.entity_key(book_id) for book_id in book_ids])
+        cache.delete(*book_pages.invalidate_all())
+    else:
+        # Pages are checked against the rows as stored, e.g. with a price sent as 5 stored as 5.0
+        stored = {row['id']: row for row in write_through_books(book_ids)}
+        for old_row, book_id in zip(old_rows, book_ids):
+            invalidate_book_pages(old_row, stored[book_id])
+
+@app.route('/books/batch', methods=['POST'])
+def add_books_batch():
+    print('Received request to add a batch of books.')
+    logger.info('Received request to add a batch of books.')
+    try:
+        rows = parse_books_batch(request.get_json(), with_id=False)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # One multi-row INSERT in a single transaction instead of a commit per book; the ids are returned in the
+    # order of the rows
+    try:
+        book_ids = db.session.scalars(insert(Book).returning(Book.id, sort_by_parameter_order=True), rows).all()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f'Failed to add books: {str(e)}')
+        logger.error(f'Failed to add books: {str(e)}')
+        return jsonify({'error': f'Failed to add books: {str(e)}'}), 500
+
+    invalidate_books_batch([None] * len(book_ids), book_ids)
+    # Replicate once for the whole batch
+    replicate_customers_db()
+
+    print(f'{len(book_ids)} books added successfully.')
+    logger.info(f'{len(book_ids)} books added successfully.')
+    return jsonify({'message': f'{len(book_ids)} books added successfully!', 'ids': book_ids})
+
+@app.route('/books/batch', methods=['PUT'])
+def update_books_batch():
+    print('Received request to update a batch of books.')
+    logger.info('Received request to update a batch of books.')
+    try:
+        rows = parse_books_batch(request.get_json(), with_id=True)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    book_ids = [row['id'] for row in rows]
+    existing = {row.id: row._asdict() for row in db.session.query(
+        Book.id, Book.title, Book.author, Book.price, Book.quantity).filter(Book.id.in_(book_ids))}
+    missing = [book_id for book_id in book_ids if book_id not in existing]
+    if missing:
+        return jsonify({'error': f'Books not found: {", ".join(map(str, missing))}'}), 404
+
+    # Bulk UPDATE by primary key, executed as one executemany in a single transaction
+    try:
+        db.session.execute(update(Book), rows)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f'Failed to update books: {str(e)}')
+        logger.error(f'Failed to update books: {str(e)}')
+        return jsonify({'error': f'Failed to update books: {str(e)}'}), 500
+
+    invalidate_books_batch([existing[book_id] for book_id in book_ids], book_ids)
+
+    print(f'{len(rows)} books updated successfully.')
+    logger.info(f'{len(rows)} books updated successfully.')
+    return jsonify({'message': f'{len(rows)} books updated successfully!'})
+
 # Function implementing the 2 Phase Commit
 @app.route('/books-2pc', methods=['POST'])
 def add_book_2pc():
@@ -184,37 +661,26 @@ def add_book_2pc():
     if books_db_connected() and customers_db_connected():
         try:
             data = request.get_json()
-            new_book = Book(title=data['title'], author=data['author'], price=data['price'], quantity=data['quantity'])
-            db.session.add(new_book)
-            db.session.commit()
-
-            if cache.exists('books'):
-                cache.clear('books')
-                print('Books cache cleared.')
-                logger.info('Books cache cleared.')
+            new_book = {'title': data['title'], 'author': data['author'], 'price': data['price'],
+                        'quantity': data['quantity']}
+            # Insert the book and increment the 'orders_count' value by 1 for every customer, atomically
+            results = two_phase_commit.execute({'books': new_book, 'customers': 1})
 
-            # Increment the 'orders_count' value by 1 for every customer
-            increment_order_count_for_customers()
+            # The inserted row as the database stores it: RETURNING reports values before column affinity applies
+            invalidate_book_pages(None, write_through_books([results['books']['id']])[0])
 
-            if cache.exists('customers'):
-                cache.clear('customers')
-                print('Customers cache cleared.')
-                logger.info('Customers cache cleared.')
+            mark_collection_stale('customers')
 
             # Replicate the updated database data after a new book is added
-            for replica_id in range(1, 5):
-                replica_db_path = os.path.join(replicas_dir, f'customers_replica{replica_id}.json')
-                try:
-                    shutil.copy(source_tinydb_db_path, replica_db_path)
-                    print(f"Data replicated successfully in replica {replica_id}")
-                    logger.info(f"Data replicated successfully in replica {replica_id}")
-                except Exception as e:
-                    print(f"Failed to replicate data in replica {replica_id}: {str(e)}")
-                    logger.error(f"Failed to replicate data in replica {replica_id}: {str(e)}")
+            replicate_customers_db()
 
             print('New book added successfully.')
             logger.info('New book added successfully.')
-            return jsonify({'message': 'New book added successfully!'})
+            return with_customers_version(jsonify({'message': 'New book added successfully!'}))
+        except TransactionAborted as e:
+            print(f'Transaction aborted, the book was not added: {str(e)}')
+            logger.error(f'Transaction aborted, the book was not added: {str(e)}')
+            return jsonify({'error': f'Transaction aborted, the book was not added: {str(e)}'}), 500
         except Exception as e:
             print(f'Failed to add customer: {str(e)}')
             logger.error(f'Failed to add customer: {str(e)}')
@@ -228,48 +694,52 @@ def add_book_2pc():
 def books_db_connected():
     try:
         db.session.query(Book).first()
+        # End the read transaction, which would otherwise keep other connections from committing
+        db.session.rollback()
         print('Connected to the books database successfully!')
         logger.info('Connected to the books database successfully!')
-        return jsonify({'message': 'Connected to the books database successfully!'})
+        return True
     except Exception as e:
         print(f'Failed to connect to books database: {str(e)}')
         logger.error(f'Failed to connect to books database: {str(e)}')
-        return jsonify({'error': f'Failed to connect to books database: {str(e)}'}), 500
+        return False
 
 
 # Function to check if the customers database is connected
 def customers_db_connected():
     try:
-        customers_table.search(Query().name.exists())
+        len(customers_store)
         print('Connected to the customers database successfully!')
         logger.info('Connected to the customers database successfully!')
-        return jsonify({'message': 'Connected to the customers database successfully!'})
+        return True
     except Exception as e:
         print(f'Failed to connect to customers database: {str(e)}')
         logger.error(f'Failed to connect to customers database: {str(e)}')
-        return jsonify({'error': f'Failed to connect to customers database: {str(e)}'}), 500
-
-# Function to increment the 'orders_count' value for every customer
-def increment_order_count_for_customers():
-    with open('customers.json', 'r') as f:
-        customers_data = json.load(f)
-
-    for customer_id, customer_info in customers_data['customers'].items():
-        updated_orders_count = customer_info.get('orders_count', 0) + 1
-        customer_info['orders_count'] = updated_orders_count
-
-    with open('customers.json', 'w') as f:
-        json.dump(customers_data, f)
+        return False
 
-    print('Orders count incremented for all customers.')
-    logger.info('Orders count incremented for all customers.')
-    return jsonify({'message': 'Orders count incremented for all customers.'})
+@app.route('/books/<int:book_id>', methods=['GET'])
+def get_book(book_id):
+    print('Received request to fetch book.')
+    logger.info('Received request to fetch book.')
+    try:
+        payload, from_cache = books_collection.fetch_entity(book_id, lambda: load_book(book_id))
+    except LookupError as e:
+        print(str(e))
+        logger.error(str(e))
+        return jsonify({'error': str(e)}), 404
+    if from_cache:
+        print('Retrieving book from the cache.')
+        logger.info('Retrieving book from the cache.')
+    if is_not_modified(request, payload.etag):
+        return not_modified_response(payload.etag)
+    return payload_response(payload)
 
 @app.route('/books/<int:book_id>', methods=['PUT'])
 def update_book(book_id):
     print('Received request to update book.')
     logger.info('Received request to update book.')
     book = Book.query.get_or_404(book_id)
+    old_book = book_to_dict(book)
     data = request.get_json()
     book.title = data['title']
     book.author = data['author']
@@ -277,10 +747,7 @@ def update_book(book_id):
     book.quantity = data['quantity']
     db.session.commit()
 
-    if cache.exists('books'):
-        cache.clear('books')
-        print('Books cache cleared.')
-        logger.info('Books cache cleared.')
+    invalidate_book_pages(old_book, write_through_books([book_id])[0])
 
     print('Book updated successfully!')
     logger.info('Book updated successfully!')
@@ -291,18 +758,52 @@ def get_customers():
     print('Received request to fetch customers.')
     logger.info('Received request to fetch customers.')
 
-    cached_customers = cache.get('customers')
-    if cached_customers:
+    # ?email= and ?name= are answered from the hash indexes of the customer store
+    for field in ('email', 'name'):
+        if field in request.args:
+            customers = customers_store.find(field, request.args[field])
+            print(f'Found {len(customers)} customers by {field}.')
+            logger.info(f'Found {len(customers)} customers by {field}.')
+            return jsonify(customers)
+
+    # Answer polls of an unchanged collection with 304 without touching the cache or the database; each
+    # representation the client can ask for has an ETag of its own
+    stream_mode = requested_stream_mode(request)
+    etag = representation_etag(versions.etag('customers'), stream_mode)
+    if is_not_modified(request, etag):
+        print('Customers not modified since the last request.')
+        logger.info('Customers not modified since the last request.')
+        return vary_on_accept(not_modified_response(etag))
+
+    # Customers can be streamed document by document instead of being encoded in one piece
+    if stream_mode:
+        print('Streaming customers from the database.')
+        logger.info('Streaming customers from the database.')
+        return vary_on_accept(streaming_response(iter(customers_store), stream_mode, etag))
+
+    # The customers database is only read on a cache miss, and only once for concurrent misses.
+    # A client that sent the version of its last write is never served stale customers.
+    payload, from_cache = read_through.fetch('customers', load_customers, etag,
+                                             allow_stale=not requested_customers_version())
+    if from_cache:
         print('Retrieving customers from the cache.')
         logger.info('Retrieving customers from the cache.')
-        return cached_customers
-
-    # Add customers to cache if they are not yet cached
-    cache.set('customers', jsonify(customers_table.all()))
-    print('Successfully added customers to the cache.')
-    logger.info('Successfully added customers to the cache.')
-
-    return jsonify(customers_table.all())
+    else:
+        print('Successfully added customers to the cache.')
+        logger.info('Successfully added customers to the cache.')
+
+    return vary_on_accept(payload_response(payload))
+
+@app.route('/customers/<int:customer_id>', methods=['GET'])
+def get_customer(customer_id):
+    print('Received request to fetch customer.')
+    logger.info('Received request to fetch customer.')
+    customer = customers_store.get(customer_id)
+    if customer is None:
+        print('Customer ID not found.')
+        logger.error('Customer ID not found.')
+        return jsonify({'error': 'Customer ID not found.'}), 404
+    return jsonify(customer)
 
 @app.route('/customers', methods=['POST'])
 def add_customer():
@@ -314,27 +815,16 @@ def add_customer():
         'email': data['email'],
         'orders_count': 0
     }
-    customers_table.insert(new_customer)
+    customers_store.insert(new_customer)
 
-    if cache.exists('customers'):
-        cache.clear('customers')
-        print('Customers cache cleared.')
-        logger.info('Customers cache cleared.')
+    mark_collection_stale('customers')
 
     # Replicate the updated database data after a new customer is added
-    for replica_id in range(1, 5):
-        replica_db_path = os.path.join(replicas_dir, f'customers_replica{replica_id}.json')
-        try:
-            shutil.copy(source_tinydb_db_path, replica_db_path)
-            print(f"Data replicated successfully in replica {replica_id}")
-            logger.info(f"Data replicated successfully in replica {replica_id}")
-        except Exception as e:
-            print(f"Failed to replicate data in replica {replica_id}: {str(e)}")
-            logger.error(f"Failed to replicate data in replica {replica_id}: {str(e)}")
+    replicate_customers_db()
 
     print('New customer added successfully!')
     logger.info('New customer added successfully!')
-    return jsonify({'message': 'New customer added successfully!'})
+    return with_customers_version(jsonify({'message': 'New customer added successfully!'}))
 
 
 @app.route('/customers/<int:customer_id>', methods=['PUT'])
@@ -348,34 +838,17 @@ def update_customer(customer_id):
             'email': data['email']
         }
 
-        with open(source_tinydb_db_path, 'r') as f:
-            customers_data = json.load(f)
-
-        if str(customer_id) in customers_data['customers']:
-            customers_data['customers'][str(customer_id)].update(updated_customer)
-
-            with open(source_tinydb_db_path, 'w') as f:
-                json.dump(customers_data, f, indent=None)
+        customer_found = customers_store.update(customer_id, updated_customer)
 
-            if cache.exists('customers'):
-                cache.clear('customers')
-                print('Customers cache cleared.')
-                logger.info('Customers cache cleared.')
+        if customer_found:
+            mark_collection_stale('customers')
 
             # Replicate the updated database data after a new customer is added
-            for replica_id in range(1, 5):
-                replica_db_path = os.path.join(replicas_dir, f'customers_replica{replica_id}.json')
-                try:
-                    shutil.copy(source_tinydb_db_path, replica_db_path)
-                    print(f"Data replicated successfully in replica {replica_id}")
-                    logger.info(f"Data replicated successfully in replica {replica_id}")
-                except Exception as e:
-                    print(f"Failed to replicate data in replica {replica_id}: {str(e)}")
-                    logger.error(f"Failed to replicate data in replica {replica_id}: {str(e)}")
+            replicate_customers_db()
 
             print('Customer updated successfully!')
             logger.info('Customer updated successfully!')
-            return jsonify({'message': 'Customer updated successfully!'})
+            return with_customers_version(jsonify({'message': 'Customer updated successfully!'}))
         else:
             print('Customer ID not found.')
             logger.error('Customer ID not found.')
@@ -0,0 +1,235 @@
+import bisect
+import threading
+import time
+import uuid
+import zlib
+from cache_utils import CacheNode, CollectionVersions, RedisCollectionVersions, decode_payload, encode_payload
+
+# Cache backends of the service. Every backend stores cached payloads under string keys and implements:
+#   get(key) -> payload or None        mget(keys) -> list of payloads or None
+#   set(key, payload, ttl=None)        delete(*keys) -> number of keys that existed
+#   versions                           collection versions with get(name), bump(name) and etag(name)
+#   acquire_lock(key, ttl) -> token or None, release_lock(key, token)
+#                                      lock keeping the threads and processes sharing the entries from rebuilding
+#                                      or patching a key at once
+#   stats()                            counters for sizing the cache
+#   after_fork()                       called in a forked process, which must not share the parent's state
+# A ttl of None stands for the backend's default TTL. Backends are chosen by configuration, so every backend
+# runs behind the same request handlers.
+
+
+# Base class of the cache backends
+class CacheBackend:
+    # Whether other processes read and write the same entries
+    shared = False
+
+    # Payloads of several keys, None for each key that is not cached
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    # Key that is only valid for the current version of a collection: a write to the collection moves its
+    # readers to new keys, and the entries of older versions are left to expire
+    def versioned_key(self, name, key):
+        return f'{key}@{name}-{self.versions.get(name)}'
+
+
+# Stable 32-bit hash of a cache key, identical in every process (unlike the salted built-in hash())
+def stable_hash(key):
+    # CRC32 is computed in C; the murmur3 finalizer spreads similar keys evenly over the ring
+    hash_value = zlib.crc32(key.encode())
+    hash_value ^= hash_value >> 16
+    hash_value = (hash_value * 0x85ebca6b) & 0xffffffff
+    hash_value ^= hash_value >> 13
+    hash_value = (hash_value * 0xc2b2ae35) & 0xffffffff
+    hash_value ^= hash_value >> 16
+    return hash_value
+
+# Consistent hashing logic to distribute keys across nodes
+class ConsistentHashing:
+    def __init__(self, num_nodes, virtual_nodes=100, **node_options):
+        # Number of points each physical node owns on the ring
+        self.virtual_nodes = virtual_nodes
+        # Budget and TTL settings passed to every cache node
+        self.node_options = node_options
+        # Cache nodes by node id
+        self.nodes = {}
+        # Sorted hash positions on the ring and the node id owning each position
+        self.ring_hashes = []
+        self.ring_node_ids = []
+        for node_id in range(num_nodes):
+            self.add_node(node_id)
+
+    # Find the node owning a given position on the ring
+    def _node_for_hash(self, hash_value):
+        # The first virtual node clockwise from the position owns it, wrapping around the ring
+        index = bisect.bisect(self.ring_hashes, hash_value) % len(self.ring_hashes)
+        return self.nodes[self.ring_node_ids[index]]
+
+    # Get the node responsible for a given key based on consistent hashing
+    def get_node(self, key, hash_value=None):
+        if not self.ring_hashes:
+            raise LookupError('Consistent hash ring has no nodes')
+        # Callers that already hashed the key pass the hash in to avoid computing it twice
+        if hash_value is None:
+            hash_value = stable_hash(key)
+        return self._node_for_hash(hash_value)
+
+    # Add a node to the ring and move to it only the keys it now owns
+    def add_node(self, node_id):
+        if node_id in self.nodes:
+            raise ValueError(f'Node {node_id} is already on the ring')
+        new_node = CacheNode(node_id, **self.node_options)
+        self.nodes[node_id] = new_node
+        for replica_index in range(self.virtual_nodes):
+            hash_value = stable_hash(f'{node_id}#{replica_index}')
+            index = bisect.bisect(self.ring_hashes, hash_value)
+            self.ring_hashes.insert(index, hash_value)
+            self.ring_node_ids.insert(index, node_id)
+
+        # Only keys falling into the arcs taken over by the new node change owner
+        moved_keys = 0
+        for node in self.nodes.values():
+            if node is new_node:
+                continue
+            for key in list(node.data):
+                if self.get_node(key) is new_node:
+                    entry = node.pop_entry(key)
+                    if entry is not None:
+                        new_node.put_entry(key, entry)
+                        moved_keys += 1
+        return moved_keys
+
+    # Remove a node from the ring and hand its keys over to their new owners
+    def remove_node(self, node_id):
+        removed_node = self.nodes.pop(node_id)
+        kept = [(hash_value, owner_id) for hash_value, owner_id in zip(self.ring_hashes, self.ring_node_ids)
+                if owner_id != node_id]
+        self.ring_hashes = [hash_value for hash_value, _ in kept]
+        self.ring_node_ids = [owner_id for _, owner_id in kept]
+
+        # Keys of the removed node are spread over the nodes following its virtual nodes
+        moved_keys = 0
+        if self.ring_hashes:
+            for key, entry in removed_node.data.items():
+                self.get_node(key).put_entry(key, entry)
+                moved_keys += 1
+        return moved_keys
+
+# Distributed cache with sharding and consistent hashing, held in the memory of the process
+class DistributedCache(CacheBackend):
+    def __init__(self, num_shards, num_replicas, virtual_nodes=100, max_entries=None, max_bytes=None, default_ttl=None):
+        # Versions are local like the cached values; the random epoch keeps ETags of different processes apart
+        self.versions = CollectionVersions()
+        self.num_shards = num_shards
+        self.num_replicas = num_replicas
+        # Create a list of sharding instances, each node bounded by the given budget and TTL
+        self.shards = [ConsistentHashing(num_replicas, virtual_nodes, max_entries=max_entries, max_bytes=max_bytes,
+                                         default_ttl=default_ttl)
+                       for _ in range(num_shards)]
+        # Held locks: key -> (token, expiry on the monotonic clock)
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    # Get the node responsible for a key
+    def get_node(self, key):
+        # Hash the key once and use it for both the shard and the ring lookup
+        hash_value = stable_hash(key)
+        # Determine the shard index based on the hash of the key
+        shard = self.shards[hash_value % self.num_shards]
+        # Get the node responsible for the key within the shard
+        return shard.get_node(key, hash_value)
+
+    # Get the value associated with a key from the cache
+    def get(self, key):
+        # Return the value associated with the key in the node's data
+        return self.get_node(key).get(key)
+
+    # Set a key-value pair in the cache, optionally overriding the default TTL in seconds
+    def set(self, key, value, ttl=None):
+        # Set the key-value pair in the node's data
+        self.get_node(key).set(key, value, ttl)
+
+    # Remove keys from the cache, returning how many of them were cached
+    def delete(self, *keys):
+        # Remove each key from its node's data if it exists
+        return sum(self.get_node(key).pop_entry(key) is not None for key in keys)
+
+    # Remove every key from every node
+    def clear(self):
+        for shard in self.shards:
+            for node in shard.nodes.values():
+                node.clear()
+
+    # Take a lock that expires after ttl seconds, returning its token or None if another thread holds it.
+    # Rebuilds of a key are single-flighted already, but writes patching an entry must also wait for its rebuild
+    def acquire_lock(self, key, ttl):
+        with self.locks_lock:
+            held = self.locks.get(key)
+            if held is not None and held[1] > time.monotonic():
+                return None
+            token = uuid.uuid4().hex
+            self.locks[key] = (token, time.monotonic() + ttl)
+            return token
+
+    # Release a lock taken with acquire_lock, unless it expired and was taken by someone else
+    def release_lock(self, key, token):
+        with self.locks_lock:
+            held = self.locks.get(key)
+            if held is not None and held[0] == token:
+                del self.locks[key]
+
+    # A forked process starts empty, with versions of its own: its writes are not seen by its parent, so the
+    # ETags the two hand out must not collide
+    def after_fork(self):
+        self.versions.after_fork()
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self.clear()
+
+    # Check if a cache with a specific key exists
+    def exists(self, key):
+        # Return True if the key exists in the node's data, False otherwise
+        return self.get_node(key).contains(key)
+
+    # Per-node counters and totals across all shards
+    def stats(self):
+        nodes = [node.stats() for shard in self.shards for node in shard.nodes.values()]
+        totals = {counter: sum(node[counter] for node in nodes)
+                  for counter in ('entries', 'bytes', 'hits', 'misses', 'evictions', 'expirations')}
+        return {'totals': totals, 'nodes': nodes}
+
+
+# Redis cluster backend, optionally with an in-process near-cache in front of it (the two-tier backend).
+# Entries and collection versions are shared by every process using the cluster; payloads are stored encoded.
+class RedisCacheBackend(CacheBackend):
+    shared = True
+
+    def __init__(self, redis_cache, default_ttl=None):
+        # A RedisClusterCache; its near-cache, if any, is kept coherent through Redis invalidations
+        self.redis_cache = redis_cache
+        self.default_ttl = default_ttl
+        self.versions = RedisCollectionVersions(redis_cache)
+
+    def get(self, key):
+        return decode_payload(self.redis_cache.get(key))
+
+    def mget(self, keys):
+        return [decode_payload(raw) for raw in self.redis_cache.mget(keys)]
+
+    def set(self, key, payload, ttl=None):
+        self.redis_cache.set(key, encode_payload(payload), ttl=ttl if ttl is not None else self.default_ttl)
+
+    def delete(self, *keys):
+        return self.redis_cache.delete(*keys)
+
+    def acquire_lock(self, key, ttl):
+        return self.redis_cache.acquire_lock(f'lock:{key}', ttl)
+
+    def release_lock(self, key, token):
+        self.redis_cache.release_lock(f'lock:{key}', token)
+
+    def stats(self):
+        return self.redis_cache.stats()
+
+    def after_fork(self):
+        self.redis_cache.after_fork()
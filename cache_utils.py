@@ -0,0 +1,610 @@
+import hashlib
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from flask import Response
+
+# Cached collection stored as pre-encoded JSON bytes together with its ETag.
+# Unlike a Flask Response it holds no request-bound state, can be sent any number of times
+# and can be stored in Redis or shared between processes.
+# created_at (wall clock, comparable between processes) and compute_time (seconds spent loading and encoding it)
+# drive soft expiry and early refresh.
+CachedPayload = namedtuple('CachedPayload', ['body', 'etag', 'created_at', 'compute_time'], defaults=(None, 0.0))
+
+
+# JSON bytes of data in the encoding of jsonify: sorted keys, compact separators, ASCII output
+def encode_json(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+# Serialize data once into the JSON bytes served on every cache hit
+def build_payload(data, etag=None):
+    body = encode_json(data)
+    # Without a collection version the ETag is derived from the content
+    if etag is None:
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    return CachedPayload(body, etag)
+
+
+# Build a JSON response from a cached payload without serializing anything
+def payload_response(payload):
+    response = Response(payload.body, mimetype='application/json')
+    response.set_etag(payload.etag)
+    response.headers['Content-Length'] = str(len(payload.body))
+    return response
+
+
+# Check whether the client already holds the representation with this ETag
+def is_not_modified(request, etag):
+    return request.if_none_match.contains_weak(etag)
+
+
+# Empty 304 response telling the client to reuse its copy
+def not_modified_response(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+# Encode a payload for a byte/string store such as Redis: "<etag> <created_at> <compute_time>\n<body>"
+def encode_payload(payload):
+    header = payload.etag
+    if payload.created_at is not None:
+        header = f'{header} {payload.created_at!r} {payload.compute_time!r}'
+    return header.encode('ascii') + b'\n' + payload.body
+
+
+# Decode a payload read back from a byte/string store, or return None if nothing was stored
+def decode_payload(raw):
+    if not raw:
+        return None
+    # Redis clients created with decode_responses=True hand back str instead of bytes
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    header, _, body = raw.partition(b'\n')
+    # Payloads stored before the timestamps were added carry only the ETag
+    etag, *timing = header.decode('ascii').split(' ')
+    if len(timing) == 2:
+        return CachedPayload(body, etag, float(timing[0]), float(timing[1]))
+    return CachedPayload(body, etag)
+
+
+# Cache node containing data, bounded by an entry and byte budget with LRU eviction and per-entry TTL
+class CacheNode:
+    def __init__(self, node_id, max_entries=None, max_bytes=None, default_ttl=None):
+        self.node_id = node_id
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        # Entries ordered from least to most recently used: key -> (value, expires_at, size)
+        self.data = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    # Estimate how many bytes a cached value takes
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, (bytes, bytearray, str)):
+            return len(value)
+        if isinstance(value, CachedPayload):
+            return len(value.body) + len(value.etag)
+        return sys.getsizeof(value)
+
+    # Get a value, dropping it if its TTL has passed
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, _ = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # Store a value, evicting least recently used entries until the node is within budget
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.default_ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self.put_entry(key, (value, expires_at, self._sizeof(value)))
+
+    # Store an entry as is, keeping its original expiry (used when keys move between nodes)
+    def put_entry(self, key, entry):
+        with self.lock:
+            if key in self.data:
+                self._drop(key)
+            self.data[key] = entry
+            self.used_bytes += entry[2]
+            while self.data and self._over_budget():
+                oldest_key = next(iter(self.data))
+                self._drop(oldest_key)
+                self.evictions += 1
+
+    # Remove an entry and return it, or None if the key is not cached
+    def pop_entry(self, key):
+        with self.lock:
+            if key not in self.data:
+                return None
+            return self._drop(key)
+
+    # Remove a key from the node if it exists
+    def delete(self, key):
+        self.pop_entry(key)
+
+    # Remove every entry
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.used_bytes = 0
+
+    # Check if a non-expired entry exists for the key
+    def contains(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            return entry is not None and (entry[1] is None or entry[1] > time.monotonic())
+
+    # Hit, miss and eviction counters for sizing the cache
+    def stats(self):
+        with self.lock:
+            return {
+                'node_id': self.node_id,
+                'entries': len(self.data),
+                'bytes': self.used_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def _over_budget(self):
+        if self.max_entries is not None and len(self.data) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.used_bytes > self.max_bytes
+
+    def _drop(self, key):
+        entry = self.data.pop(key)
+        self.used_bytes -= entry[2]
+        return entry
+
+
+# In-flight call shared by every request that asked for the same key
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Coalesces concurrent calls for the same key so the underlying function runs once
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    # Check whether a call for the key is running
+    def in_flight(self, key):
+        with self.lock:
+            return key in self.calls
+
+    # Run fn for the key, or wait for the call already in flight and share its result
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+# Read-through cache of serialized collections on top of any get/set store, protected against stampedes.
+# A payload is stale once it was built for another collection version (a write happened), once it is older than
+# soft_ttl, or earlier with a probability that grows as its soft expiry nears and with the time it took to build
+# (probabilistic early refresh, weighted by early_refresh_beta). A stale payload is rebuilt by a single caller:
+# concurrent callers of the process share its call, and callers of other processes are kept out by a lock in the
+# store, acquired through acquire_lock(key, ttl) -> token or None and released through release_lock(key, token).
+# Meanwhile the others keep serving the stale payload (stale-while-revalidate), or, when nothing usable is cached,
+# wait up to lock_wait seconds for the rebuilt one.
+class ReadThroughCache:
+    def __init__(self, get_payload, set_payload, acquire_lock=None, release_lock=None, soft_ttl=None,
+                 early_refresh_beta=1.0, lock_ttl=10.0, lock_wait=5.0):
+        # get_payload(key) returns a CachedPayload or None, set_payload(key, payload) stores one
+        self.get_payload = get_payload
+        self.set_payload = set_payload
+        self.acquire_lock = acquire_lock
+        self.release_lock = release_lock
+        self.soft_ttl = soft_ttl
+        self.early_refresh_beta = early_refresh_beta
+        self.lock_ttl = lock_ttl
+        self.lock_wait = lock_wait
+        self.single_flight = SingleFlight()
+        self.stale_hits = 0
+        self.refreshes = 0
+
+    # Return (payload, from_cache); load() is only called on a miss, once per burst of concurrent misses.
+    # When an ETag is given, a cached payload built for another collection version is stale. Stale payloads
+    # are only served when allow_stale is set, e.g. not to a client that must read its own writes.
+    # build(data, etag) encodes the loaded data, build_payload by default.
+    def fetch(self, key, load, etag=None, allow_stale=True, build=build_payload):
+        payload = self.get_payload(key)
+        if payload and self._is_fresh(payload, etag):
+            return payload, True
+        if payload and allow_stale:
+            # Someone else is already rebuilding the key, so the stale payload is served in the meantime
+            if self.single_flight.in_flight(key):
+                self.stale_hits += 1
+                return payload, True
+            rebuilt = self.single_flight.do(key, lambda: self._fill(key, load, etag, build))
+            if rebuilt is None:
+                self.stale_hits += 1
+                return payload, True
+            return rebuilt, False
+        rebuilt = self.single_flight.do(key, lambda: self._fill(key, load, etag, build))
+        if rebuilt is None:
+            rebuilt = self._wait_for_rebuild(key, load, etag, build)
+        return rebuilt, False
+
+    def _is_fresh(self, payload, etag):
+        if etag is not None and payload.etag != etag:
+            return False
+        if self.soft_ttl is None or payload.created_at is None:
+            return True
+        # Refresh early with a probability growing as the soft expiry nears: -log(random) is 0 to about 10
+        expires_at = payload.created_at + self.soft_ttl
+        early = payload.compute_time * self.early_refresh_beta * -math.log(1.0 - random.random())
+        return time.time() + early < expires_at
+
+    # Rebuild the payload under the store's lock; returns None if another thread or process holds the lock and a
+    # stale payload can be served instead
+    def _fill(self, key, load, etag, build):
+        # A flight that finished just before this one started may already have filled the key
+        payload = self.get_payload(key)
+        if payload and self._is_fresh(payload, etag):
+            return payload
+        token = None
+        if self.acquire_lock is not None:
+            token = self.acquire_lock(key, self.lock_ttl)
+            if token is None:
+                return None
+        try:
+            # Or the holder of the lock, e.g. a write patching it
+            payload = self.get_payload(key)
+            if payload and self._is_fresh(payload, etag):
+                return payload
+            started = time.monotonic()
+            payload = build(load(), etag)
+            payload = payload._replace(created_at=time.time(), compute_time=time.monotonic() - started)
+            self.set_payload(key, payload)
+            self.refreshes += 1
+            return payload
+        finally:
+            if token is not None:
+                self.release_lock(key, token)
+
+    # Wait for another process to store the rebuilt payload, and rebuild it here if it takes too long.
+    # A payload built after the wait started reflects every write before it, even if it has a newer version.
+    def _wait_for_rebuild(self, key, load, etag, build):
+        started_at = time.time()
+        deadline = time.monotonic() + self.lock_wait
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            payload = self.get_payload(key)
+            if payload and (etag is None or payload.etag == etag or (payload.created_at or 0) >= started_at):
+                return payload
+        payload = build(load(), etag)._replace(created_at=time.time())
+        self.set_payload(key, payload)
+        return payload
+
+    # Counters of the stampede protection
+    def stats(self):
+        return {'stale_hits': self.stale_hits, 'refreshes': self.refreshes}
+
+
+# Collection cached both whole, as a JSON array under its name, and entity by entity under "<entity>:<id>".
+# The whole collection is encoded from the entity encodings, and an index of where each entity sits in it is
+# cached under "<name>:index", so a write patches the cached array in place (write-through) instead of leaving
+# it to be rebuilt. Entities are ordered by id; new ones must have the highest ids and are appended.
+# A patch only applies to the payload of the version just before the write, with an index matching its body,
+# and under the lock a rebuild takes, so a write waits for a rebuild in progress; otherwise the collection is left
+# stale and rebuilt as usual.
+class CachedCollection:
+    def __init__(self, name, entity, cache, read_through, versions):
+        self.name = name
+        self.entity = entity
+        self.cache = cache
+        self.read_through = read_through
+        self.versions = versions
+        self.index_key = f'{name}:index'
+        # Writes of this process queue here rather than polling the store's lock
+        self.lock = threading.Lock()
+        self.patches = 0
+        self.patch_misses = 0
+
+    def entity_key(self, entity_id):
+        return f'{self.entity}:{entity_id}'
+
+    # Return (payload, from_cache) for the whole collection; load() returns the entities in id order.
+    # The cached collection is checked against the current version rather than the request's, and a rebuild
+    # is labelled with the version read before loading, so that a write made since the request started does not
+    # make a patched or rebuilt collection stale.
+    def fetch(self, load, allow_stale=True):
+        def load_with_version():
+            return self.versions.get(self.name), load()
+        return self.read_through.fetch(self.name, load_with_version, self.versions.etag(self.name), allow_stale,
+                                       build=self._build)
+
+    # Return (payload, from_cache) for one entity; load() returns it or raises LookupError
+    def fetch_entity(self, entity_id, load):
+        return self.read_through.fetch(self.entity_key(entity_id), load)
+
+    # Record a write of the given entities, after it was committed: their entries are replaced, and the cached
+    # collection is patched and moved to the new version. load(entity_ids) returns the entities as stored, in id
+    # order. Returns the loaded entities and whether the collection could be patched.
+    def write_through(self, entity_ids, load):
+        keys = [self.entity_key(entity_id) for entity_id in sorted(set(entity_ids))] + [self.name]
+        tokens = {}
+        with self.lock:
+            try:
+                # The entries and the collection are replaced under the locks a refill takes, so that a refill which
+                # loaded them before the write cannot store them over the new entries
+                for key in keys:
+                    tokens[key] = self._wait_for_rebuild(key)
+                # Loaded under the locks, so that of two concurrent writes of an entity the one written through
+                # last stores the latest rows, whatever order they were committed in
+                entities = load(entity_ids)
+                created_at = time.time()
+                for entity in entities:
+                    self.cache.set(self.entity_key(entity['id']), build_payload(entity)._replace(created_at=created_at))
+                if tokens[self.name] is not None:
+                    patched = self._patch(entities)
+                else:
+                    # Still being rebuilt, by a data load that may have missed this write
+                    self.versions.bump(self.name)
+                    patched = False
+            finally:
+                for key, token in tokens.items():
+                    if token is not None:
+                        self.cache.release_lock(key, token)
+        if patched:
+            self.patches += 1
+        else:
+            self.patch_misses += 1
+        return entities, patched
+
+    # Take the lock a rebuild of the key holds, waiting up to lock_wait seconds for a rebuild in progress to finish,
+    # so that the rebuilt payload is updated instead of left stale by the write. Returns the lock's token, or None
+    # if the rebuild takes longer.
+    def _wait_for_rebuild(self, key):
+        deadline = time.monotonic() + self.read_through.lock_wait
+        while True:
+            token = self.cache.acquire_lock(key, self.read_through.lock_ttl)
+            if token is not None or time.monotonic() >= deadline:
+                return token
+            time.sleep(0.01)
+
+    # Patch and replace the cached collection; the version is moved on in any case
+    def _patch(self, entities):
+        version = self.versions.get(self.name)
+        new_version = self.versions.bump(self.name)
+        payload, index = self.cache.mget([self.name, self.index_key])
+        # Another write moved the version in between, or the cached payload misses earlier writes
+        if new_version != version + 1 or payload is None or index is None:
+            return False
+        if payload.etag != self.versions.etag(self.name, version):
+            return False
+        index = json.loads(index.body)
+        if index['hash'] != _body_hash(payload.body):
+            return False
+
+        body = payload.body
+        ids, offsets = index['ids'], index['offsets']
+        positions = {entity_id: position for position, entity_id in enumerate(ids)}
+        for entity in entities:
+            encoded = encode_json(entity)
+            position = positions.get(entity['id'])
+            if position is None:
+                if ids and entity['id'] < ids[-1]:
+                    return False
+                # Appended before the closing bracket
+                start = len(body) - 1
+                if ids:
+                    body = body[:start] + b',' + encoded + b']'
+                    start += 1
+                else:
+                    body = body[:start] + encoded + b']'
+                positions[entity['id']] = len(ids)
+                ids.append(entity['id'])
+                offsets.append(start)
+                continue
+            start = offsets[position]
+            end = offsets[position + 1] - 1 if position + 1 < len(offsets) else len(body) - 1
+            body = body[:start] + encoded + body[end:]
+            delta = len(encoded) - (end - start)
+            if delta:
+                for later in range(position + 1, len(offsets)):
+                    offsets[later] += delta
+
+        patched = payload._replace(body=body, etag=self.versions.etag(self.name, new_version))
+        self.cache.set(self.index_key, build_payload({'hash': _body_hash(body), 'ids': ids, 'offsets': offsets}))
+        self.cache.set(self.name, patched)
+        return True
+
+    # Encode the collection from its entity encodings, caching the index of their positions
+    def _build(self, loaded, etag):
+        version, entities = loaded
+        ids = []
+        offsets = []
+        parts = []
+        position = 1
+        for entity in entities:
+            encoded = encode_json(entity)
+            ids.append(entity['id'])
+            offsets.append(position)
+            parts.append(encoded)
+            position += len(encoded) + 1
+        body = b'[' + b','.join(parts) + b']'
+        self.cache.set(self.index_key, build_payload({'hash': _body_hash(body), 'ids': ids, 'offsets': offsets}))
+        return CachedPayload(body, self.versions.etag(self.name, version))
+
+    # Patch counters
+    def stats(self):
+        return {'patches': self.patches, 'patch_misses': self.patch_misses}
+
+
+def _body_hash(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+# Per-process version counters of the cached collections, bumped by every write.
+# The random epoch keeps ETags of different processes and restarts from colliding.
+class CollectionVersions:
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        self.versions = {}
+
+    # Current version of a collection
+    def get(self, name):
+        return self.versions.get(name, 0)
+
+    # Record a write to a collection, returning its new version
+    def bump(self, name):
+        with self.lock:
+            self.versions[name] = self.versions.get(name, 0) + 1
+            return self.versions[name]
+
+    # Strong ETag of the current or the given version of a collection
+    def etag(self, name, version=None):
+        return f'{name}-{self.epoch}-{self.get(name) if version is None else version}'
+
+    # Start the versions of a forked process over, under an epoch of its own
+    def after_fork(self):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        self.versions = {}
+
+
+# Version counters kept in Redis so that every worker and container agrees on them
+class RedisCollectionVersions:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    # Current version of a collection, seeded with the current time so a flushed Redis does not reuse old ETags
+    def get(self, name):
+        key = f'version:{name}'
+        version = self.redis_client.get(key)
+        if version is None:
+            self.redis_client.set(key, time.time_ns(), nx=True)
+            version = self.redis_client.get(key)
+        return int(version)
+
+    # Record a write to a collection, returning its new version
+    def bump(self, name):
+        self.get(name)
+        return self.redis_client.incr(f'version:{name}')
+
+    # Strong ETag of the current or the given version of a collection
+    def etag(self, name, version=None):
+        return f'{name}-{self.get(name) if version is None else version}'
+
+
+# Key ranges of cached keyset pages, so that a write only invalidates the pages it actually affects.
+# A page holds the rows whose (sort value, id) key follows its cursor, up to its last row; a page that
+# was not full extends to the end of the collection.
+# Past max_pages the oldest pages are forgotten, and dropped from the cache through delete(*cache_keys) since no
+# later write could invalidate them.
+class KeysetPageIndex:
+    def __init__(self, delete, max_pages=10000):
+        self.delete = delete
+        self.max_pages = max_pages
+        self.lock = threading.Lock()
+        # Cache key -> page bounds, oldest first
+        self.pages = OrderedDict()
+        # Number of invalidations so far; a page loaded across an invalidation is not cached
+        self.seq = 0
+
+    # Register a page loaded at start_seq and store it through store() unless a write happened meanwhile.
+    # row_filter(row), if given, tells whether a row can appear on the page at all.
+    def register(self, cache_key, sort, descending, cursor_id, lower_key, upper_key, start_seq, store,
+                 row_filter=None):
+        with self.lock:
+            if self.seq != start_seq:
+                return False
+            self.pages[cache_key] = (sort, descending, cursor_id, lower_key, upper_key, row_filter)
+            self.pages.move_to_end(cache_key)
+            evicted = []
+            while len(self.pages) > self.max_pages:
+                evicted.append(self.pages.popitem(last=False)[0])
+            if evicted:
+                self.delete(*evicted)
+            # Storing under the lock keeps a concurrent invalidation from running between register and store
+            store()
+            return True
+
+    # Return the cache keys of the pages affected by a row changing from old_row to new_row (either may be None)
+    def invalidate_row(self, old_row, new_row):
+        row_id = (old_row or new_row)['id']
+        with self.lock:
+            self.seq += 1
+            affected = []
+            for cache_key, (sort, descending, cursor_id, lower_key, upper_key, row_filter) in self.pages.items():
+                # The cursor row itself moved, so the page it starts must be resolved again
+                if cursor_id == row_id:
+                    affected.append(cache_key)
+                    continue
+                for row in (old_row, new_row):
+                    if row is None or (row_filter is not None and not row_filter(row)):
+                        continue
+                    if self._in_page((row[sort], row['id']), descending, lower_key, upper_key):
+                        affected.append(cache_key)
+                        break
+            for cache_key in affected:
+                del self.pages[cache_key]
+            return affected
+
+    # Drop every page, e.g. after a bulk change
+    def invalidate_all(self):
+        with self.lock:
+            self.seq += 1
+            affected = list(self.pages)
+            self.pages.clear()
+            return affected
+
+    @staticmethod
+    def _in_page(key, descending, lower_key, upper_key):
+        if descending:
+            return (lower_key is None or key < lower_key) and (upper_key is None or key >= upper_key)
+        return (lower_key is None or key > lower_key) and (upper_key is None or key <= upper_key)
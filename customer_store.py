@@ -0,0 +1,315 @@
+import atexit
+import copy
+from array import array
+import json
+import logging
+import os
+import threading
+from replication_log import apply_entries, read_snapshot_seq, write_snapshot_seq
+
+logger = logging.getLogger(__name__)
+
+
+# Customer storage engine: the change log is the write-ahead log and the TinyDB JSON file is its compacted snapshot.
+# Documents are kept in memory, so a write costs one appended log line instead of a rewrite of the whole file.
+# The file is written back like a write cache by a background thread: after compact_every entries, every
+# flush_interval seconds if one is given, and on shutdown, each time atomically (temporary file, fsync, rename) and tagged with
+# the log position it holds; loading replays the log entries after that position. Writers are only blocked
+# while the data is copied, not while it is encoded and written. Entries are durable in the log before they are applied,
+# so nothing written is lost between flushes.
+# Writes hold the write lock shared with other processes and first catch up with the entries they appended.
+# Hash indexes on indexed_fields answer lookups by value without scanning the documents.
+# Integer counter_fields are kept out of the documents in columns indexed by document id, plus a per-column
+# offset, so incrementing a counter of every document is a single addition; documents read from the store
+# always carry their counters.
+class CustomerStore:
+    def __init__(self, path, change_log, write_lock, table='customers', compact_every=1000, flush_interval=None,
+                 indexed_fields=('email', 'name'), counter_fields=('orders_count',)):
+        self.path = path
+        self.change_log = change_log
+        self.write_lock = write_lock
+        self.table = table
+        self.compact_every = compact_every
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.compact_lock = threading.Lock()
+        # Contents of the TinyDB file: table name -> {document id as string: document}
+        self.data = {}
+        # Indexed field -> value -> ids of the documents holding it
+        self.indexes = {field: {} for field in indexed_fields}
+        # Counter field -> column of values minus the offset, indexed by document id, and the column's offset
+        self.counters = {field: array('q') for field in counter_fields}
+        self.counter_offsets = {field: 0 for field in counter_fields}
+        self.flush_thread = None
+        self.flush_requested = threading.Event()
+        # Log position reflected by self.data, and the one the file on disk holds
+        self.seq = 0
+        self.snapshot_seq = 0
+        self.last_id = 0
+        self.load()
+        atexit.register(self.close)
+
+    # Read the compacted file and replay the log entries written after it
+    def load(self):
+        with self.write_lock, self.lock:
+            self.change_log.reload()
+            self._read_file()
+            # Tag a file written before the log became its write-ahead log, so later loads replay from here
+            if os.path.exists(self.path) and not os.path.exists(self.path + '.seq'):
+                write_snapshot_seq(self.path, self.seq, os.stat(self.path).st_ino, self.seq)
+            # The log was reset while the data was kept, so new entries must be numbered after it
+            if self.seq > self.change_log.head_seq:
+                logger.warning(f'Change log is behind the customers file, continuing from sequence {self.seq}')
+                self.change_log.advance_to(self.seq)
+            self.refresh()
+
+    # Apply the entries appended to the log since the last refresh, by this or another process
+    def refresh(self):
+        with self.lock:
+            self.change_log.reload()
+            entries = self.change_log.entries_since(self.seq)
+            if entries is None:
+                # Other processes wrote so much that the log was truncated; their last compaction has the rest
+                self._read_file()
+                entries = self.change_log.entries_since(self.seq)
+            if entries is None:
+                logger.error(f'Change log no longer holds the entries after sequence {self.seq}, '
+                             f'continuing from the customers file')
+                self.seq = self.change_log.head_seq
+                return
+            if not entries:
+                return
+            for entry in entries:
+                if entry['table'] == self.table:
+                    self._apply(entry)
+                else:
+                    apply_entries(self.data, [entry])
+            self.seq = entries[-1]['seq']
+
+    # All documents of the table, as copies
+    def all(self):
+        with self.lock:
+            self.refresh()
+            return [self._materialize(doc_id, document) for doc_id, document in self._documents().items()]
+
+    # Document with the given id, or None
+    def get(self, doc_id):
+        with self.lock:
+            self.refresh()
+            document = self._documents().get(str(doc_id))
+            return self._materialize(str(doc_id), document) if document is not None else None
+
+    # Documents whose indexed field equals value, in id order
+    def find(self, field, value):
+        if field not in self.indexes:
+            raise ValueError(f'Customers are not indexed by {field}')
+        with self.lock:
+            self.refresh()
+            doc_ids = sorted(self.indexes[field].get(value, ()), key=int)
+            documents = self._documents()
+            return [self._materialize(doc_id, documents[doc_id]) for doc_id in doc_ids]
+
+    # Iterate over copies of the documents without holding the lock while they are consumed
+    def __iter__(self):
+        with self.lock:
+            self.refresh()
+            documents = list(self._documents().items())
+        for doc_id, document in documents:
+            yield self._materialize(doc_id, document)
+
+    def __len__(self):
+        with self.lock:
+            self.refresh()
+            return len(self._documents())
+
+    # Insert a document and return its id
+    def insert(self, document):
+        with self.write_lock, self.lock:
+            self.refresh()
+            doc_id = self.last_id + 1
+            self._write('upsert', doc_id=doc_id, doc=document)
+            return doc_id
+
+    # Insert several documents and return their ids
+    def insert_multiple(self, documents):
+        return [self.insert(document) for document in documents]
+
+    # Update fields of a document, returning False if it does not exist
+    def update(self, doc_id, fields):
+        with self.write_lock, self.lock:
+            self.refresh()
+            if str(doc_id) not in self._documents():
+                return False
+            self._write('update', doc_id=doc_id, fields=fields)
+            return True
+
+    # Add amount to a field of every document; metadata, e.g. transaction ids, is recorded with the log entry
+    def increment_all(self, field, amount=1, **metadata):
+        with self.write_lock, self.lock:
+            self.refresh()
+            self._write('increment_all', field=field, amount=amount, **metadata)
+
+    # Rewrite the file with everything logged so far; returns False if it was already up to date
+    def compact(self):
+        # Only the copy of the data holds the locks; writes go on while it is encoded and written
+        with self.compact_lock:
+            with self.write_lock, self.lock:
+                self.refresh()
+                if self.seq == self.snapshot_seq:
+                    return False
+                seq = self.seq
+                data = {name: copy.deepcopy(documents) for name, documents in self.data.items() if name != self.table}
+                documents = list(self._documents().items())
+                counters = [(field, array(column.typecode, column), self.counter_offsets[field])
+                            for field, column in self.counters.items()]
+
+            # Counters are added back into copies of the documents outside the locks
+            data[self.table] = table = {}
+            for doc_id, document in documents:
+                index = int(doc_id)
+                table[doc_id] = dict(document, **{field: column[index] + offset
+                                                  for field, column, offset in counters})
+
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+                inode = os.fstat(f.fileno()).st_ino
+
+            with self.write_lock, self.lock:
+                file_seq = read_snapshot_seq(self.path, self.snapshot_seq)
+                # Another process compacted further in the meantime
+                if file_seq >= seq:
+                    os.remove(temp_path)
+                    self.snapshot_seq = file_seq
+                    return False
+                write_snapshot_seq(self.path, seq, inode, file_seq)
+                os.replace(temp_path, self.path)
+                self.snapshot_seq = seq
+            logger.info(f'Customers file compacted at sequence {seq}')
+            return True
+
+    # Flush everything logged so far on shutdown
+    def close(self):
+        try:
+            self.compact()
+        except Exception as e:
+            logger.error(f'Failed to flush the customers file on shutdown: {str(e)}')
+
+    # Start the background flush; done lazily so that no thread exists before a server forks its workers
+    def start(self):
+        with self.lock:
+            if self.flush_thread is not None:
+                return
+            self.flush_thread = threading.Thread(target=self._run_flush, daemon=True, name='customers-flush')
+            self.flush_thread.start()
+
+    # Flush every flush_interval seconds, and as soon as compact_every entries are waiting
+    def _run_flush(self):
+        while True:
+            self.flush_requested.wait(self.flush_interval or None)
+            self.flush_requested.clear()
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f'Failed to flush the customers file: {str(e)}')
+
+    # Apply one entry of this table, keeping the indexes, counters and the last id in step
+    # Documents are never changed in place but replaced, so a compaction can copy references instead of documents
+    def _apply(self, entry):
+        documents = self.data.setdefault(self.table, {})
+        if entry['op'] == 'increment_all':
+            field, amount = entry['field'], entry['amount']
+            if field in self.counters:
+                self.counter_offsets[field] += amount
+                return
+            for doc_id, document in documents.items():
+                documents[doc_id] = dict(document, **{field: document.get(field, 0) + amount})
+            if field in self.indexes:
+                self._build_indexes()
+            return
+        if entry['op'] not in ('upsert', 'update'):
+            raise ValueError(f"Unknown change log operation: {entry['op']}")
+        doc_id = str(entry['doc_id'])
+        self._index(doc_id, remove=True)
+        if entry['op'] == 'upsert':
+            documents[doc_id] = copy.deepcopy(entry['doc'])
+        else:
+            documents[doc_id] = dict(documents.get(doc_id, {}), **copy.deepcopy(entry['fields']))
+        self._take_counters(doc_id, replace=entry['op'] == 'upsert')
+        self._index(doc_id)
+        if entry['op'] == 'upsert':
+            self.last_id = max(self.last_id, int(doc_id))
+
+    # Move the counter fields of a document into their columns; a replaced document without one starts at 0
+    def _take_counters(self, doc_id, replace):
+        document = self._documents()[doc_id]
+        for field, column in self.counters.items():
+            if field not in document and not replace:
+                continue
+            value = int(document.pop(field, 0))
+            index = int(doc_id)
+            if index >= len(column):
+                column.frombytes(bytes(column.itemsize * (index + 1 - len(column))))
+            column[index] = value - self.counter_offsets[field]
+
+    # Copy of a document with its counters
+    def _materialize(self, doc_id, document):
+        document = dict(document)
+        index = int(doc_id)
+        for field, column in self.counters.items():
+            document[field] = column[index] + self.counter_offsets[field]
+        return document
+
+    def _index(self, doc_id, remove=False):
+        document = self._documents().get(doc_id)
+        if document is None:
+            return
+        for field, index in self.indexes.items():
+            value = document.get(field)
+            if not isinstance(value, (str, int, float, bool)):
+                continue
+            if remove:
+                doc_ids = index.get(value)
+                if doc_ids is not None:
+                    doc_ids.discard(doc_id)
+                    if not doc_ids:
+                        del index[value]
+            else:
+                index.setdefault(value, set()).add(doc_id)
+
+    def _build_indexes(self):
+        for index in self.indexes.values():
+            index.clear()
+        for doc_id in self._documents():
+            self._index(doc_id)
+
+    def _read_file(self):
+        try:
+            with open(self.path, 'r') as f:
+                self.data = json.load(f)
+            self.snapshot_seq = read_snapshot_seq(self.path, self.change_log.head_seq)
+        except FileNotFoundError:
+            self.data = {}
+            self.snapshot_seq = 0
+        self.seq = self.snapshot_seq
+        self.last_id = max((int(doc_id) for doc_id in self._documents()), default=0)
+        for field in self.counters:
+            self.counters[field] = array('q', bytes(8 * (self.last_id + 1)))
+            self.counter_offsets[field] = 0
+        for doc_id in self._documents():
+            self._take_counters(doc_id, replace=True)
+        self._build_indexes()
+
+    def _documents(self):
+        return self.data.get(self.table, {})
+
+    # Log the change first, then apply it to memory through the same path as changes of other processes
+    def _write(self, op, **fields):
+        self.start()
+        self.change_log.append(op, self.table, **fields)
+        self.refresh()
+        # The flush runs in the background, so this write does not wait for the file to be rewritten
+        if self.seq - self.snapshot_seq >= self.compact_every:
+            self.flush_requested.set()
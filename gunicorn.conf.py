@@ -0,0 +1,32 @@
+import multiprocessing
+import os
+
+# Production server settings of the bookstore service, read by gunicorn from the working directory:
+#   gunicorn bookstore_service:app
+# SERVICE_WORKERS processes each serve up to SERVICE_THREADS requests at a time: workers spread the CPU-bound work
+# (JSON encoding, cache lookups) over the cores, which the threads of one process cannot, and threads overlap the
+# waits on SQLite, Redis and the replicas.
+# With SERVICE_PRELOAD the app is imported once before the workers are forked, so they share its memory and start
+# faster; each worker gets its own connections, cache and transaction log right after the fork (see
+# reset_after_fork in bookstore_service.py).
+
+bind = os.environ.get('SERVICE_BIND', '0.0.0.0:5050')
+# The local cache backend lives in each worker, which would go on serving what it cached after a write made by
+# another worker, so it is only served by a single worker; shared backends default to one worker per core
+cache_backend = os.environ.get('CACHE_BACKEND', 'local')
+workers = int(os.environ.get('SERVICE_WORKERS', 1 if cache_backend == 'local' else multiprocessing.cpu_count()))
+if workers > 1 and cache_backend == 'local':
+    raise RuntimeError('The local cache backend is not shared between workers; '
+                       'set CACHE_BACKEND to redis or two-tier to run several workers')
+threads = int(os.environ.get('SERVICE_THREADS', 4))
+worker_class = 'gthread'
+preload_app = os.environ.get('SERVICE_PRELOAD', '1') == '1'
+# Seconds a worker may spend on a request before it is restarted
+timeout = int(os.environ.get('SERVICE_TIMEOUT', 30))
+
+
+# Create or check the databases in every worker once it has loaded the app, rather than in the server before it
+# forks them, so that the server holds no thread or lock when it does
+def post_worker_init(worker):
+    import bookstore_service
+    bookstore_service.create_databases()
@@ -0,0 +1,130 @@
+import json
+import logging
+import random
+import threading
+import time
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+
+# A place customers can be read from, with its load and health
+class ReadBackend:
+    def __init__(self, name, url=None, replica_path=None):
+        self.name = name
+        self.url = url
+        self.replica_path = replica_path
+        # The primary is always healthy; replicas only once a health check has passed
+        self.healthy = url is None
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.reads = 0
+        self.errors = 0
+
+
+# Spreads customer reads over the primary database and the replica servers.
+# Each read picks the less loaded of two random eligible backends (power of two choices). A replica is
+# eligible when it is healthy and has applied at least the change log position the read requires, which
+# gives read-your-writes for clients that send back the version returned by their last write.
+# Replicas failing failure_threshold health checks or reads in a row are ejected until a check passes again.
+class CustomerReadRouter:
+    def __init__(self, read_primary, replicas, replica_sync, health_interval=5.0, timeout=2.0, failure_threshold=2):
+        # read_primary() returns the list of customers, replicas is a list of (url, replica file path)
+        self.read_primary = read_primary
+        self.replica_sync = replica_sync
+        self.health_interval = health_interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.primary = ReadBackend('primary')
+        self.replicas = [ReadBackend(f'replica{replica_id}', url, replica_path)
+                         for replica_id, (url, replica_path) in enumerate(replicas, start=1)]
+        self.lock = threading.Lock()
+        self.health_thread = None
+
+    # Start the health checks; done lazily so that no thread exists before a server forks its workers
+    def start(self):
+        with self.lock:
+            if self.health_thread is not None:
+                return
+            self.health_thread = threading.Thread(target=self._run_health_checks, daemon=True,
+                                                  name='customer-read-router-health')
+            self.health_thread.start()
+
+    # Read all customers from a backend that has applied at least min_seq, returning (customers, backend name)
+    def read(self, min_seq):
+        self.start()
+        backend = self._choose(min_seq)
+        with self.lock:
+            backend.in_flight += 1
+        try:
+            if backend is self.primary:
+                customers = self.read_primary()
+            else:
+                customers = self._read_replica(backend)
+            backend.reads += 1
+            backend.consecutive_failures = 0
+            return customers, backend.name
+        except Exception as e:
+            backend.errors += 1
+            if backend is self.primary:
+                raise
+            logger.error(f'Failed to read customers from {backend.name}, falling back to the primary: {str(e)}')
+            self._record_failure(backend)
+            return self.read_primary(), self.primary.name
+        finally:
+            with self.lock:
+                backend.in_flight -= 1
+
+    # Health and load of every backend
+    def status(self):
+        backends = [self.primary] + self.replicas
+        return {backend.name: {'healthy': backend.healthy, 'in_flight': backend.in_flight, 'reads': backend.reads,
+                               'errors': backend.errors, 'consecutive_failures': backend.consecutive_failures,
+                               'applied_seq': self.replica_sync.applied_seq(backend.replica_path)
+                               if backend.replica_path else None}
+                for backend in backends}
+
+    # Check every replica once, ejecting or re-admitting it
+    def check_health(self):
+        for backend in self.replicas:
+            try:
+                with urllib.request.urlopen(backend.url, timeout=self.timeout) as response:
+                    response.read()
+                if not backend.healthy:
+                    logger.info(f'{backend.name} passed its health check and serves reads again')
+                backend.healthy = True
+                backend.consecutive_failures = 0
+            except Exception as e:
+                logger.warning(f'Health check of {backend.name} failed: {str(e)}')
+                self._record_failure(backend)
+
+    def _choose(self, min_seq):
+        candidates = [self.primary]
+        for backend in self.replicas:
+            if not backend.healthy:
+                continue
+            # Read the position from disk, as the replicas may be synced by another process
+            applied_seq = self.replica_sync.read_seq(backend.replica_path)
+            if applied_seq is not None and applied_seq >= min_seq:
+                candidates.append(backend)
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if first.in_flight <= second.in_flight else second
+
+    def _read_replica(self, backend):
+        with urllib.request.urlopen(backend.url, timeout=self.timeout) as response:
+            data = json.loads(response.read())
+        return list(data.get('customers', {}).values())
+
+    def _record_failure(self, backend):
+        backend.consecutive_failures += 1
+        if backend.healthy and backend.consecutive_failures >= self.failure_threshold:
+            backend.healthy = False
+            logger.warning(f'{backend.name} ejected from customer reads after '
+                           f'{backend.consecutive_failures} consecutive failures')
+
+    def _run_health_checks(self):
+        while True:
+            self.check_health()
+            time.sleep(self.health_interval)
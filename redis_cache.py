@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+import uuid
+import redis
+from rediscluster import RedisCluster
+from rediscluster.connection import ClusterBlockingConnectionPool
+
+logger = logging.getLogger(__name__)
+
+# Channel Redis publishes client-side caching invalidations on for RESP2 clients
+invalidation_channel = '__redis__:invalidate'
+
+# Deletes a lock only if it still holds the caller's token, so an expired lock taken over by another process
+# is not released by its previous holder
+release_lock_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+# Cache adapter for a Redis cluster: a bounded pool of connections per node, pipelined multi-key operations and
+# an optional in-process near-cache in front of Redis.
+# The near-cache is kept coherent with client-side tracking in broadcast mode (Redis 6+): one connection per
+# master subscribes to the invalidations of every key written on that master, by any client. Values are only
+# served from the near-cache while every master's invalidation connection is up; when one drops, the near-cache
+# is emptied and bypassed until it is subscribed again. The near-cache's TTL bounds staleness should an
+# invalidation be missed.
+class RedisClusterCache:
+    def __init__(self, startup_nodes, max_connections=64, pool_timeout=5.0, socket_timeout=1.0, near_cache=None,
+                 reconnect_interval=1.0):
+        # Connections are capped per node and threads wait for a free one instead of failing when all are busy
+        self.pool = ClusterBlockingConnectionPool(startup_nodes=startup_nodes, max_connections=max_connections,
+                                                  max_connections_per_node=True, timeout=pool_timeout,
+                                                  skip_full_coverage_check=True, socket_timeout=socket_timeout,
+                                                  socket_connect_timeout=socket_timeout, socket_keepalive=True)
+        self.client = RedisCluster(connection_pool=self.pool)
+        self.socket_timeout = socket_timeout
+        self.reconnect_interval = reconnect_interval
+        # Any store with get(key), set(key, value), delete(key) and clear(), e.g. a CacheNode
+        self.near_cache = near_cache
+        self.lock = threading.Lock()
+        # Master name -> listener thread, and the masters whose invalidations are currently received
+        self.listeners = {}
+        self.subscribed = set()
+        # Bumped by every invalidation, so a value read from Redis across one is not put in the near-cache
+        self.generation = 0
+        self.invalidations = 0
+
+    # Value of a key as bytes, or None
+    def get(self, key):
+        if self.near_cache is None:
+            return self.client.get(key)
+        self.start()
+        if self._near_cache_usable():
+            value = self.near_cache.get(key)
+            if value is not None:
+                return value
+        generation = self.generation
+        value = self.client.get(key)
+        self._fill_local(generation, {key: value})
+        return value
+
+    # Values of several keys, None for each missing key; keys not in the near-cache are read in one pipelined
+    # round trip per node
+    def mget(self, keys):
+        values = {}
+        if self.near_cache is not None:
+            self.start()
+            if self._near_cache_usable():
+                for key in keys:
+                    value = self.near_cache.get(key)
+                    if value is not None:
+                        values[key] = value
+        missing = [key for key in keys if key not in values]
+        if missing:
+            generation = self.generation
+            pipeline = self.client.pipeline(transaction=False)
+            for key in missing:
+                pipeline.get(key)
+            fetched = dict(zip(missing, pipeline.execute()))
+            self._fill_local(generation, fetched)
+            values.update(fetched)
+        return [values[key] for key in keys]
+
+    # Store a value, expiring after ttl seconds if given; with nx it is only stored if the key does not exist
+    def set(self, key, value, ttl=None, nx=False):
+        self._invalidate_local([key])
+        return self.client.set(key, value, px=int(ttl * 1000) if ttl is not None else None, nx=nx)
+
+    # Increment an integer value and return the new value
+    def incr(self, key, amount=1):
+        self._invalidate_local([key])
+        return self.client.incr(key, amount)
+
+    # Delete keys in one pipelined round trip per node, returning how many existed
+    def delete(self, *keys):
+        if not keys:
+            return 0
+        self._invalidate_local(keys)
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.delete(key)
+        return sum(pipeline.execute())
+
+    # Take a lock that expires after ttl seconds (SET NX), returning its token or None if someone else holds it
+    def acquire_lock(self, name, ttl):
+        token = uuid.uuid4().hex
+        if self.client.set(name, token, px=int(ttl * 1000), nx=True):
+            return token
+        return None
+
+    # Release a lock taken with acquire_lock, unless it expired and was taken by someone else
+    def release_lock(self, name, token):
+        self.client.eval(release_lock_script, 1, name, token)
+
+    # Near-cache and invalidation state
+    def stats(self):
+        return {'near_cache': self.near_cache.stats() if self.near_cache is not None else None,
+                'subscribed_masters': sorted(self.subscribed),
+                'invalidations': self.invalidations}
+
+    # Start the invalidation listeners; done lazily so that no thread or connection exists before a server forks
+    def start(self):
+        if self.near_cache is None:
+            return
+        with self.lock:
+            if self.listeners:
+                return
+        self._sync_listeners()
+
+    # Forget the invalidation listeners of the parent process, whose threads do not exist after a fork, along with
+    # the near-cache they kept coherent; the connection pool reconnects by itself in a new process
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.listeners = {}
+        self.subscribed = set()
+        if self.near_cache is not None:
+            self._clear_local()
+
+    def _near_cache_usable(self):
+        return bool(self.listeners) and len(self.subscribed) == len(self.listeners)
+
+    # Keep values read from Redis in the near-cache, unless an invalidation arrived since they were read
+    def _fill_local(self, generation, values):
+        if self.near_cache is None:
+            return
+        with self.lock:
+            if generation != self.generation or not self._near_cache_usable():
+                return
+            for key, value in values.items():
+                if value is not None:
+                    self.near_cache.set(key, value)
+
+    def _invalidate_local(self, keys):
+        if self.near_cache is None:
+            return
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.near_cache.delete(key)
+
+    def _clear_local(self):
+        with self.lock:
+            self.generation += 1
+            self.near_cache.clear()
+
+    # Run one listener per current master, e.g. after a failover promoted a replica
+    def _sync_listeners(self):
+        masters = {node['name']: node for node in self.pool.nodes.all_masters()}
+        with self.lock:
+            for name in list(self.listeners):
+                if name not in masters:
+                    del self.listeners[name]
+                    self.subscribed.discard(name)
+            for name, node in masters.items():
+                if name not in self.listeners:
+                    thread = threading.Thread(target=self._run_listener, args=(node,), daemon=True,
+                                              name=f'redis-invalidation-{name}')
+                    self.listeners[name] = thread
+                    thread.start()
+
+    def _run_listener(self, node):
+        name = node['name']
+        while self.listeners.get(name) is threading.current_thread():
+            try:
+                self._listen(node)
+            except Exception as e:
+                logger.error(f'Lost the near-cache invalidations of Redis node {name}, bypassing it: {str(e)}')
+            with self.lock:
+                self.subscribed.discard(name)
+            self._clear_local()
+            time.sleep(self.reconnect_interval)
+            try:
+                # The node may no longer be a master; refresh the cluster layout before subscribing again
+                self.pool.nodes.initialize()
+                self._sync_listeners()
+            except Exception as e:
+                logger.error(f'Failed to refresh the Redis cluster layout: {str(e)}')
+
+    # Subscribe to the invalidations of every key of a master and apply them until the connection fails
+    def _listen(self, node):
+        connection = redis.Connection(host=node['host'], port=node['port'], socket_timeout=self.socket_timeout,
+                                      socket_connect_timeout=self.socket_timeout, socket_keepalive=True)
+        try:
+            connection.connect()
+            connection.send_command('CLIENT', 'ID')
+            client_id = connection.read_response()
+            # Broadcast mode reports writes to any key, not only the keys this connection read
+            connection.send_command('CLIENT', 'TRACKING', 'on', 'REDIRECT', client_id, 'BCAST')
+            connection.read_response()
+            connection.send_command('SUBSCRIBE', invalidation_channel)
+            connection.read_response()
+            # Anything cached before the subscription may have changed unnoticed
+            self._clear_local()
+            with self.lock:
+                self.subscribed.add(node['name'])
+            logger.info(f"Receiving near-cache invalidations from Redis node {node['name']}")
+            while self.listeners.get(node['name']) is threading.current_thread():
+                if not connection.can_read(timeout=self.socket_timeout):
+                    # An idle connection is checked so that a dead node is noticed
+                    connection.send_command('PING')
+                    continue
+                message = connection.read_response()
+                if message[0] != b'message':
+                    continue
+                keys = message[2]
+                self.invalidations += 1
+                if keys is None:
+                    # The node was flushed
+                    self._clear_local()
+                else:
+                    self._invalidate_local([key.decode('utf-8') for key in keys])
+        finally:
+            connection.disconnect()
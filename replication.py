@@ -1,26 +1,56 @@
+import gzip
+import hashlib
+import json
 import os
-import shutil
 import time
 import threading
 import logging
-from flask import Flask
+from flask import Flask, Response, jsonify, request, send_file
+from waitress import serve
+from replication_log import (ChangeLog, InterProcessLock, ReplicaSync, apply_entries, read_replica_tail,
+                             replica_pending, replica_tail_path)
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
-source_tinydb_db_path = os.path.join(script_dir, 'customers.json')
-replicas_dir = os.path.join(script_dir, 'replicas')
+# Directory of the databases, logs and replicas: the directory of this file unless BOOKSTORE_DATA_DIR is set
+data_dir = os.environ.get('BOOKSTORE_DATA_DIR', script_dir)
+source_tinydb_db_path = os.path.join(data_dir, 'customers.json')
+replicas_dir = os.path.join(data_dir, 'replicas')
+change_log_path = os.path.join(data_dir, 'customers_changes.log')
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# How often the primary database is checked for changes, and how long a burst of writes may settle, in seconds
+poll_interval = float(os.environ.get('REPLICATION_POLL_INTERVAL', 0.2))
+debounce_interval = float(os.environ.get('REPLICATION_DEBOUNCE', 0.1))
+max_debounce_interval = float(os.environ.get('REPLICATION_MAX_DEBOUNCE', 1.0))
+
+# Replica files up to this size are served from memory; larger ones are sent straight from disk
+max_in_memory_replica_size = int(os.environ.get('REPLICA_MAX_IN_MEMORY_SIZE', 64 * 1024 * 1024))
+# Responses smaller than this are not worth compressing
+min_gzip_size = 1024
+
+# Replica n listens on replica_base_port + n; all replicas share one pool of server threads
+replica_base_port = 5070
+replica_server_threads = int(os.environ.get('REPLICA_SERVER_THREADS', 8))
+
+# Same lock file as the bookstore service, so snapshots never interleave with a customer write
+customers_write_lock = InterProcessLock(source_tinydb_db_path + '.lock')
+change_log = ChangeLog(change_log_path)
+replica_paths = [os.path.join(replicas_dir, f'customers_replica{replica_id}.json') for replica_id in range(1, 5)]
+replica_sync = ReplicaSync(source_tinydb_db_path, replica_paths, change_log, customers_write_lock)
+
 
 def replicate_tinydb():
     try:
         os.makedirs(replicas_dir, exist_ok=True)
 
-        if os.path.exists(source_tinydb_db_path):
-            for replica_id in range(1, 5):
-                destination_tinydb_db_path = os.path.join(replicas_dir, f'customers_replica{replica_id}.json')
-                shutil.copy(source_tinydb_db_path, destination_tinydb_db_path)
+        # Until the service first compacts customers.json, its changes are only in the change log
+        change_log.reload()
+        if os.path.exists(source_tinydb_db_path) or change_log.head_seq:
+            # Snapshots record the change log position they match, so later incremental syncs apply on top of them
+            for replica_id, destination_tinydb_db_path in enumerate(replica_paths, start=1):
+                replica_sync.snapshot(destination_tinydb_db_path)
                 logger.info(f"TinyDB database replicated successfully for replica {replica_id}")
                 print(f"TinyDB database replicated successfully for replica {replica_id} at",
                       time.strftime('%Y-%m-%d %H:%M:%S'))
@@ -28,38 +58,194 @@ def replicate_tinydb():
             print('Source TinyDB database file not found.')
             logger.error('Source TinyDB database file not found.')
     except Exception as e:
-        logger.error("Error occurred during replication:", str(e))
+        logger.error(f"Error occurred during replication: {str(e)}")
         print("Error occurred during replication:", str(e))
 
 
-def create_replica_app(replica_path, port):
+# Signature of a file that changes whenever the file is written or replaced
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+# Push the changes made since the last sync to every replica
+def sync_replicas():
+    for replica_id, replica_path in enumerate(replica_paths, start=1):
+        result = replica_sync.sync(replica_path)
+        if result:
+            print(f"Replica {replica_id} synced: {result}")
+            logger.info(f"Replica {replica_id} synced: {result}")
+
+
+# Watch the customers change log, and sync the replicas once a burst of writes has settled.
+# Every customer write goes through the log; the primary file itself only changes when the log is compacted into it.
+def watch_and_replicate():
+    signature = file_signature(change_log_path)
+    while True:
+        time.sleep(poll_interval)
+        current = file_signature(change_log_path)
+        if current == signature:
+            continue
+
+        # Debounce: wait until the log stops changing, but never longer than max_debounce_interval
+        debounce_started = time.monotonic()
+        while time.monotonic() - debounce_started < max_debounce_interval:
+            time.sleep(debounce_interval)
+            settled = file_signature(change_log_path)
+            if settled == current:
+                break
+            current = settled
+
+        signature = current
+        try:
+            sync_replicas()
+        except Exception as e:
+            logger.error(f"Error occurred during replication: {str(e)}")
+            print("Error occurred during replication:", str(e))
+
+
+# One version of a replica: its pre-encoded response bodies. A version is never changed once loaded (the compressed
+# body is only added to it), so a response built from it is consistent whatever reloads happen meanwhile.
+class ReplicaVersion:
+    def __init__(self, signature, body):
+        self.signature = signature
+        self.body = body
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.lock = threading.Lock()
+        self.gzip_body = None
+
+    # Body compressed once per version and reused for every gzip-capable client
+    def compressed_body(self):
+        with self.lock:
+            if self.gzip_body is None:
+                self.gzip_body = gzip.compress(self.body, compresslevel=6)
+            return self.gzip_body
+
+
+# Size of a replica's log tail, 0 if it has none
+def tail_size(replica_path):
+    try:
+        return os.stat(replica_tail_path(replica_path)).st_size
+    except FileNotFoundError:
+        return 0
+
+
+# In-memory copy of a replica: its file, reloaded only when the file is rewritten, plus the entries of its log tail,
+# applied as they are appended
+class ReplicaSnapshot:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Held while the file and its tail are read, so a sync or snapshot never changes them halfway
+        self.replica_lock = InterProcessLock(path + '.lock')
+        self.version = None
+        self.data = None
+        self.file_signature = None
+        self.tail_offset = 0
+
+    # Return the current version of the replica, catching up first if its file or tail changed since the last load
+    def current(self):
+        signature = (file_signature(self.path), tail_size(self.path))
+        version = self.version
+        if version is None or signature != version.signature:
+            with self.lock:
+                if self.version is None or signature != self.version.signature:
+                    self._load()
+                version = self.version
+        return version
+
+    def _load(self):
+        with self.replica_lock:
+            # A sync or snapshot that was interrupted may have left a tail that does not match the file
+            if self.version is not None and replica_pending(self.path):
+                return
+            signature = (file_signature(self.path), tail_size(self.path))
+            body = None
+            if signature[0] != self.file_signature or signature[1] < self.tail_offset:
+                with open(self.path, 'rb') as f:
+                    body = f.read()
+                try:
+                    data = json.loads(body)
+                except ValueError as e:
+                    # Keep serving the previous version rather than a file that cannot be parsed
+                    logger.error(f"Replica file {self.path} could not be parsed, "
+                                 f"serving the previous version: {str(e)}")
+                    if self.version is None:
+                        raise
+                    return
+                self.data = data
+                self.file_signature = signature[0]
+                self.tail_offset = 0
+            entries, self.tail_offset = read_replica_tail(self.path, self.tail_offset)
+        if entries:
+            apply_entries(self.data, entries)
+        # The file is served as it is until entries are applied on top of it
+        if entries or body is None:
+            body = json.dumps(self.data).encode('utf-8')
+        self.version = ReplicaVersion(signature, body)
+
+
+# Response for GET /customers of one replica
+def replica_response(replica_path, snapshot):
+    # Large files without a tail to apply are streamed from disk by the server (sendfile where supported) instead
+    # of held in memory
+    signature = file_signature(replica_path)
+    if signature is not None and signature[2] > max_in_memory_replica_size and not tail_size(replica_path):
+        return send_file(replica_path, mimetype='application/json', conditional=True, etag=True)
+
+    current = snapshot.current()
+    if request.if_none_match.contains_weak(current.etag):
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings and len(current.body) >= min_gzip_size:
+        response = Response(current.compressed_body(), mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(current.body, mimetype='application/json')
+    response.set_etag(current.etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# One application serving every replica, either on the replica's own port (5070 + replica id)
+# or under /replicas/<replica id>/customers on any of the ports
+def create_replicas_app():
     app = Flask(__name__)
+    snapshots = {replica_id: ReplicaSnapshot(replica_path)
+                 for replica_id, replica_path in enumerate(replica_paths, start=1)}
+
+    def serve_replica(replica_id):
+        print(f'Received request to retrieve data from replica {replica_id}')
+        logger.info(f'Received request to retrieve data from replica {replica_id}')
+        if replica_id not in snapshots:
+            return jsonify({'error': f'Replica {replica_id} not found.'}), 404
+        return replica_response(replica_paths[replica_id - 1], snapshots[replica_id])
 
     @app.route('/customers', methods=['GET'])
     def get_data():
-        print('Received request to retrieve data from the replica')
-        logger.info('Received request to retrieve data from the replica')
-        with open(replica_path, 'r') as f:
-            data = f.read()
-        return data
+        return serve_replica(int(request.environ['SERVER_PORT']) - replica_base_port)
+
+    @app.route('/replicas/<int:replica_id>/customers', methods=['GET'])
+    def get_replica_data(replica_id):
+        return serve_replica(replica_id)
+
+    return app
 
-    app.run(debug=True, host='0.0.0.0', port=port, use_reloader=False)
 
 def main():
-    while True:
-        replicate_tinydb()
-        time.sleep(1)
+    replicate_tinydb()
 
-        threads = []
-        for replica_id in range(1, 5):
-            replica_path = os.path.join(replicas_dir, f'customers_replica{replica_id}.json')
-            thread = threading.Thread(target=create_replica_app, args=(replica_path, 5070 + replica_id))
-            thread.start()
-            threads.append(thread)
+    # The replicator runs in the background while the replicas are served
+    threading.Thread(target=watch_and_replicate, daemon=True, name='replicator').start()
 
-        for thread in threads:
-            thread.join()
+    # A single process serves all replicas on their ports with a production WSGI server and a shared thread pool
+    listen = ' '.join(f'0.0.0.0:{replica_base_port + replica_id}' for replica_id in range(1, len(replica_paths) + 1))
+    print(f'Serving replicas on {listen} with {replica_server_threads} threads')
+    logger.info(f'Serving replicas on {listen} with {replica_server_threads} threads')
+    serve(create_replicas_app(), listen=listen, threads=replica_server_threads)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
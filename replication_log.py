@@ -0,0 +1,459 @@
+import copy
+import json
+import logging
+import os
+import shutil
+import queue
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where locking falls back to the current process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+# Reentrant lock shared by the threads of a process and, through flock on a lock file, by other processes
+class InterProcessLock:
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if self.depth == 0 and fcntl is not None:
+            self.file = open(self.path, 'a')
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0 and self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+        self.thread_lock.release()
+
+
+# Append-only log of customer mutations, one JSON entry per line, each with an increasing sequence number.
+# Entries are:
+#   {"seq": n, "op": "upsert", "table": t, "doc_id": id, "doc": {...}}   insert or replace a document
+#   {"seq": n, "op": "update", "table": t, "doc_id": id, "fields": {...}} update fields of a document
+#   {"seq": n, "op": "increment_all", "table": t, "field": f, "amount": k} increment a field of every document
+class ChangeLog:
+    def __init__(self, path, max_entries=10000, compacted_seq=None):
+        self.path = path
+        # Once the log grows past max_entries the older half is dropped; replicas that far behind get a snapshot
+        self.max_entries = max_entries
+        # compacted_seq() returns the position up to which the entries are held by a compacted file. When the log
+        # is the write-ahead log of that file, later entries are its only copy and are never dropped.
+        self.compacted_seq = compacted_seq
+        self.lock = threading.Lock()
+        self.entries = []
+        self.head_seq = 0
+        # Position up to which the file has been read, and the inode it was read from
+        self.offset = 0
+        self.inode = None
+        self.reload()
+
+    # Read entries appended to the file by another process since the last read
+    def reload(self):
+        with self.lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return
+            # The file was truncated and replaced, so read it again from the start
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self.entries = []
+                self.offset = 0
+                self.inode = stat.st_ino
+            if stat.st_size == self.offset:
+                return
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+            # A line still being written by another process is read on the next reload
+            complete = data[:data.rfind(b'\n') + 1]
+            for line in complete.splitlines():
+                if line.strip():
+                    self.entries.append(json.loads(line))
+            self.offset += len(complete)
+            if self.entries:
+                self.head_seq = self.entries[-1]['seq']
+
+    # Append an entry and return its sequence number
+    def append(self, op, table, **fields):
+        with self.lock:
+            entry = dict(fields, seq=self.head_seq + 1, op=op, table=table, ts=time.time())
+            with open(self.path, 'ab') as f:
+                f.write((json.dumps(entry) + '\n').encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+                self.offset = f.tell()
+                self.inode = os.fstat(f.fileno()).st_ino
+            self.head_seq = entry['seq']
+            self.entries.append(entry)
+            if len(self.entries) > self.max_entries:
+                keep = self.max_entries // 2
+                if self.compacted_seq is not None:
+                    keep = max(keep, self.head_seq - self.compacted_seq())
+                # Otherwise the log grows until the file is compacted
+                if keep < len(self.entries):
+                    self._truncate(keep)
+            return entry['seq']
+
+    # Continue numbering after seq, e.g. when the log was deleted but the data it led to was kept
+    def advance_to(self, seq):
+        with self.lock:
+            if seq > self.head_seq:
+                self.head_seq = seq
+
+    # Time an entry was appended, or None if it is not in the log
+    def entry_time(self, seq):
+        with self.lock:
+            if not self.entries:
+                return None
+            index = seq - self.entries[0]['seq']
+            if 0 <= index < len(self.entries):
+                return self.entries[index].get('ts')
+            return None
+
+    # Entries newer than seq, or None if the log no longer holds all of them
+    def entries_since(self, seq):
+        with self.lock:
+            if self.entries and self.entries[0]['seq'] > seq + 1:
+                return None
+            if not self.entries and seq < self.head_seq:
+                return None
+            return [entry for entry in self.entries if entry['seq'] > seq]
+
+    def _truncate(self, keep):
+        self.entries = self.entries[-keep:]
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            for entry in self.entries:
+                f.write((json.dumps(entry) + '\n').encode('utf-8'))
+            self.offset = f.tell()
+        os.replace(temp_path, self.path)
+        self.inode = os.stat(self.path).st_ino
+
+
+# Apply change log entries to the data of a TinyDB JSON file
+def apply_entries(data, entries):
+    for entry in entries:
+        table = data.setdefault(entry['table'], {})
+        # Entries are shared by every replica, so documents are copied rather than stored and mutated in place
+        if entry['op'] == 'upsert':
+            table[str(entry['doc_id'])] = copy.deepcopy(entry['doc'])
+        elif entry['op'] == 'update':
+            table.setdefault(str(entry['doc_id']), {}).update(copy.deepcopy(entry['fields']))
+        elif entry['op'] == 'increment_all':
+            for document in table.values():
+                document[entry['field']] = document.get(entry['field'], 0) + entry['amount']
+        else:
+            raise ValueError(f"Unknown change log operation: {entry['op']}")
+    return data
+
+
+# Write a JSON file atomically so readers never see a half-written file
+def write_json_atomic(path, data):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+# Change log position of a compacted primary file, recorded in "<path>.seq" as "<seq> <inode> <previous seq>".
+# The .seq file is written before the compacted file replaces the old one, so if that replacement never
+# happened (the file has another inode) the file still holds the previous position.
+# A file without a .seq file was written on every change and is taken to be at `default`, the head of the log.
+def read_snapshot_seq(path, default):
+    try:
+        with open(path + '.seq', 'r') as f:
+            seq, inode, previous_seq = (int(value) for value in f.read().split())
+        return seq if os.stat(path).st_ino == inode else previous_seq
+    except (OSError, ValueError):
+        return default
+
+
+def write_snapshot_seq(path, seq, inode, previous_seq):
+    temp_path = path + '.seq.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(f'{seq} {inode} {previous_seq}')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path + '.seq')
+
+
+# Path of the log tail of a replica: the change log entries applied to it since its file was last rewritten
+def replica_tail_path(replica_path):
+    return replica_path + '.log'
+
+
+# Whether a replica was left in the middle of a sync or snapshot, so its file and tail may not match
+def replica_pending(replica_path):
+    try:
+        with open(replica_path + '.seq', 'r') as f:
+            return f.read().strip() == 'pending'
+    except OSError:
+        return False
+
+
+# Read the entries of a replica tail from offset, returning them and the offset after the last complete line
+def read_replica_tail(replica_path, offset=0):
+    try:
+        with open(replica_tail_path(replica_path), 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], 0
+    complete = data[:data.rfind(b'\n') + 1]
+    return [json.loads(line) for line in complete.splitlines() if line.strip()], offset + len(complete)
+
+
+# Brings replicas up to date with the primary by applying only the change log entries they miss.
+# A replica is its file, a full snapshot, plus its log tail: the entries applied since the snapshot, which a sync
+# appends to instead of rewriting the file. The replica servers apply the tail to the data they hold in memory.
+# Once the tail holds max_tail entries the file is rewritten from a new snapshot and the tail emptied.
+# Each replica records the last applied sequence number next to its file ("<replica>.seq"). The file and its tail
+# are only changed, and must only be read, under the replica's lock ("<replica>.lock").
+class ReplicaSync:
+    def __init__(self, source_path, replica_paths, change_log, write_lock, max_lag=1000, max_tail=1000):
+        self.source_path = source_path
+        self.replica_paths = replica_paths
+        self.change_log = change_log
+        # Lock held while the primary is written and logged, so a snapshot matches its sequence number
+        self.write_lock = write_lock
+        # Replicas further behind than this are refreshed from a full snapshot instead
+        self.max_lag = max_lag
+        self.max_tail = max_tail
+        # Replicas can be synced in parallel, but each one by a single thread of a single process at a time
+        self.sync_locks = {replica_path: InterProcessLock(replica_path + '.lock') for replica_path in replica_paths}
+        # Last known applied sequence number of each replica
+        self.applied = {}
+
+    # Sync every replica, returning {replica_path: number of entries applied, or 'snapshot'}
+    def sync_all(self):
+        results = {}
+        for replica_path in self.replica_paths:
+            results[replica_path] = self.sync(replica_path)
+        return results
+
+    # Sync one replica by appending the entries it misses to its tail
+    def sync(self, replica_path):
+        with self.sync_locks[replica_path]:
+            # Pick up entries appended by other processes
+            self.change_log.reload()
+            applied_seq = self.read_seq(replica_path)
+            # Unknown, interrupted or foreign positions (e.g. a deleted log) cannot be caught up incrementally
+            if applied_seq is None or applied_seq > self.change_log.head_seq or not os.path.exists(replica_path) \
+                    or self.change_log.head_seq - applied_seq > self.max_lag:
+                return self.snapshot(replica_path)
+            entries = self.change_log.entries_since(applied_seq)
+            if entries is None:
+                return self.snapshot(replica_path)
+            if not entries:
+                return 0
+            # Replaying a long tail costs the replica servers more than loading a new snapshot
+            if self.tail_length(replica_path, applied_seq) + len(entries) > self.max_tail:
+                return self.snapshot(replica_path)
+
+            # Entries are not all idempotent, so mark the position as unknown until the whole batch is appended
+            self.write_seq(replica_path, 'pending')
+            with open(replica_tail_path(replica_path), 'ab') as f:
+                f.write(b''.join((json.dumps(entry) + '\n').encode('utf-8') for entry in entries))
+            self.write_seq(replica_path, entries[-1]['seq'])
+            return len(entries)
+
+    # Number of entries in the tail of a replica that has applied applied_seq, read from its first entry
+    def tail_length(self, replica_path, applied_seq):
+        try:
+            with open(replica_tail_path(replica_path), 'rb') as f:
+                first_line = f.readline()
+        except FileNotFoundError:
+            return 0
+        if not first_line.strip():
+            return 0
+        return applied_seq - json.loads(first_line)['seq'] + 1
+
+    # Make every replica take a full snapshot on its next sync, e.g. after a change could not be logged
+    def force_snapshot(self):
+        for replica_path in self.replica_paths:
+            self.write_seq(replica_path, 'pending')
+
+    # Replace a replica with a full copy of the primary
+    def snapshot(self, replica_path):
+        with self.sync_locks[replica_path]:
+            self.write_seq(replica_path, 'pending')
+            with self.write_lock:
+                self.change_log.reload()
+                seq = self.change_log.head_seq
+                # The primary file only holds the changes up to its last compaction, the rest are still in the log.
+                # Until the first compaction there is no primary file and the log holds every change.
+                source_exists = os.path.exists(self.source_path)
+                source_seq = read_snapshot_seq(self.source_path, seq) if source_exists else 0
+                entries = self.change_log.entries_since(source_seq) if source_seq < seq else []
+                if entries:
+                    data = {}
+                    if source_exists:
+                        with open(self.source_path, 'r') as f:
+                            data = json.load(f)
+                    write_json_atomic(replica_path, apply_entries(data, entries))
+                else:
+                    if entries is None:
+                        logger.error(f'Change log no longer holds the entries after sequence {source_seq}, '
+                                     f'replica {replica_path} is refreshed from the primary file alone')
+                        seq = source_seq
+                    if source_exists:
+                        temp_path = replica_path + '.tmp'
+                        shutil.copy(self.source_path, temp_path)
+                        os.replace(temp_path, replica_path)
+                    else:
+                        write_json_atomic(replica_path, {})
+            # The new file holds everything the tail held
+            open(replica_tail_path(replica_path), 'wb').close()
+            self.write_seq(replica_path, seq)
+        logger.info(f'Replica {replica_path} refreshed from a full snapshot at sequence {seq}')
+        return 'snapshot'
+
+    # Applied sequence number of a replica, None if unknown
+    def applied_seq(self, replica_path):
+        if replica_path not in self.applied:
+            self.applied[replica_path] = self.read_seq(replica_path)
+        return self.applied[replica_path]
+
+    def read_seq(self, replica_path):
+        try:
+            with open(replica_path + '.seq', 'r') as f:
+                seq = int(f.read().strip())
+        except (OSError, ValueError):
+            seq = None
+        self.applied[replica_path] = seq
+        return seq
+
+    def write_seq(self, replica_path, seq):
+        temp_path = replica_path + '.seq.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(str(seq))
+        os.replace(temp_path, replica_path + '.seq')
+        self.applied[replica_path] = seq if isinstance(seq, int) else None
+
+
+# Propagates change log entries to the replicas off the request path.
+# Modes: "sync" syncs every replica before returning, "async" only schedules the syncs, and "quorum"
+# waits until `quorum` replicas have applied the change (or the timeout passes).
+# Each replica has one worker thread and a queue holding at most one pending sync; a sync catches up to
+# the head of the log, so a burst of writes collapses into a single propagation per replica.
+class ReplicationWorker:
+    modes = ('sync', 'async', 'quorum')
+
+    def __init__(self, replica_sync, mode='async', quorum=2, timeout=5.0):
+        if mode not in self.modes:
+            raise ValueError(f'Replication mode must be one of: {", ".join(self.modes)}')
+        if mode == 'quorum' and not 1 <= quorum <= len(replica_sync.replica_paths):
+            raise ValueError(f'Replication quorum must be between 1 and {len(replica_sync.replica_paths)}')
+        self.replica_sync = replica_sync
+        self.mode = mode
+        self.quorum = quorum
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.pending = {replica_path: queue.Queue(maxsize=1) for replica_path in replica_sync.replica_paths}
+        self.stats = {replica_path: {'syncs': 0, 'snapshots': 0, 'entries_applied': 0, 'errors': 0,
+                                     'last_error': None, 'last_sync_at': None, 'last_sync_seconds': None}
+                      for replica_path in replica_sync.replica_paths}
+        self.threads = []
+        self.start_lock = threading.Lock()
+
+    # Start the worker threads; done lazily so that no thread exists before a server forks its workers
+    def start(self):
+        with self.start_lock:
+            if self.threads:
+                return
+            for replica_path in self.replica_sync.replica_paths:
+                thread = threading.Thread(target=self._run, args=(replica_path,), daemon=True,
+                                          name=f'replication-{os.path.basename(replica_path)}')
+                thread.start()
+                self.threads.append(thread)
+
+    # Propagate everything logged so far according to the mode; returns False if a quorum was not reached in time
+    def replicate(self):
+        target_seq = self.replica_sync.change_log.head_seq
+        if self.mode == 'sync':
+            for replica_path in self.replica_sync.replica_paths:
+                self._sync(replica_path)
+            return True
+
+        self.start()
+        for pending in self.pending.values():
+            try:
+                pending.put_nowait(target_seq)
+            except queue.Full:
+                # A sync is already scheduled and will pick this change up as well
+                pass
+        if self.mode == 'async':
+            return True
+        return self.wait_for(target_seq, self.quorum, self.timeout)
+
+    # Wait until `count` replicas have applied seq, returning False on timeout
+    def wait_for(self, seq, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self._replicas_at(seq) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    # Per-replica lag in entries and seconds, plus sync counters
+    def lag(self):
+        head_seq = self.replica_sync.change_log.head_seq
+        now = time.time()
+        replicas = {}
+        for replica_path in self.replica_sync.replica_paths:
+            applied_seq = self.replica_sync.applied_seq(replica_path)
+            lag_entries = head_seq - applied_seq if applied_seq is not None else None
+            lag_seconds = 0.0
+            if lag_entries:
+                oldest_missing = self.replica_sync.change_log.entry_time(applied_seq + 1)
+                lag_seconds = now - oldest_missing if oldest_missing is not None else None
+            replicas[os.path.basename(replica_path)] = dict(self.stats[replica_path], applied_seq=applied_seq,
+                                                            lag_entries=lag_entries, lag_seconds=lag_seconds)
+        return {'mode': self.mode, 'quorum': self.quorum, 'head_seq': head_seq, 'replicas': replicas}
+
+    def _replicas_at(self, seq):
+        return sum(1 for replica_path in self.replica_sync.replica_paths
+                   if (self.replica_sync.applied_seq(replica_path) or 0) >= seq)
+
+    def _run(self, replica_path):
+        while True:
+            self.pending[replica_path].get()
+            self._sync(replica_path)
+
+    def _sync(self, replica_path):
+        stats = self.stats[replica_path]
+        started = time.monotonic()
+        try:
+            result = self.replica_sync.sync(replica_path)
+            stats['syncs'] += 1
+            if result == 'snapshot':
+                stats['snapshots'] += 1
+            else:
+                stats['entries_applied'] += result
+            if result:
+                logger.info(f'Replica {os.path.basename(replica_path)} synced: {result}')
+        except Exception as e:
+            stats['errors'] += 1
+            stats['last_error'] = str(e)
+            logger.error(f'Failed to replicate data in replica {os.path.basename(replica_path)}: {str(e)}')
+        stats['last_sync_at'] = time.time()
+        stats['last_sync_seconds'] = time.monotonic() - started
+        with self.condition:
+            self.condition.notify_all()
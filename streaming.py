@@ -0,0 +1,70 @@
+from flask import Response, stream_with_context
+from cache_utils import encode_json
+
+ndjson_mimetype = 'application/x-ndjson'
+
+# Number of items encoded together into one chunk of the response body
+stream_chunk_size = 500
+
+
+# Yield a JSON array chunk by chunk, holding at most one chunk of items in memory
+def iter_json_array(items, chunk_size=stream_chunk_size):
+    yield b'['
+    chunk = []
+    first = True
+    for item in items:
+        chunk.append(encode_json(item))
+        if len(chunk) >= chunk_size:
+            yield (b'' if first else b',') + b','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield (b'' if first else b',') + b','.join(chunk)
+    yield b']'
+
+
+# Yield newline-delimited JSON, one item per line, in chunks
+def iter_ndjson(items, chunk_size=stream_chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(encode_json(item) + b'\n')
+        if len(chunk) >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+    if chunk:
+        yield b''.join(chunk)
+
+
+# Streaming mode asked for by the client: "ndjson", "json" or None for a regular response
+def requested_stream_mode(request):
+    stream = request.args.get('stream', '').lower()
+    if stream == 'ndjson':
+        return 'ndjson'
+    if stream in ('1', 'true', 'json'):
+        return 'json'
+    if request.accept_mimetypes.best == ndjson_mimetype:
+        return 'ndjson'
+    return None
+
+
+# ETag of a collection in the representation of a streaming mode: NDJSON has bytes of its own, while a streamed
+# JSON array is the same representation as the cached one
+def representation_etag(etag, mode):
+    return f'{etag}-ndjson' if mode == 'ndjson' else etag
+
+
+# The representation of a collection is negotiated on the Accept header, so caches must key it on that header too
+def vary_on_accept(response):
+    response.vary.add('Accept')
+    return response
+
+
+# Response streaming the items as a JSON array or as NDJSON while they are read
+def streaming_response(items, mode, etag=None):
+    if mode == 'ndjson':
+        response = Response(stream_with_context(iter_ndjson(items)), mimetype=ndjson_mimetype)
+    else:
+        response = Response(stream_with_context(iter_json_array(items)), mimetype='application/json')
+    if etag is not None:
+        response.set_etag(etag)
+    return response
@@ -0,0 +1,30 @@
+import importlib
+import os
+import sys
+import pytest
+
+# The service modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# The bookstore service with the local cache, its databases and logs in a temporary directory
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / 'replicas')
+    monkeypatch.setenv('BOOKSTORE_DATA_DIR', str(tmp_path))
+    monkeypatch.setenv('CACHE_BACKEND', 'local')
+    monkeypatch.setenv('REPLICATION_MODE', 'sync')
+    # No replica servers run during the tests
+    monkeypatch.setenv('CUSTOMER_REPLICA_URLS', ','.join(f'http://127.0.0.1:9/{i}' for i in range(1, 5)))
+    sys.modules.pop('bookstore_service', None)
+    module = importlib.import_module('bookstore_service')
+    module.create_databases()
+    yield module
+    with module.app.app_context():
+        module.db.engine.dispose()
+    sys.modules.pop('bookstore_service', None)
+
+
+@pytest.fixture
+def client(service):
+    return service.app.test_client()
@@ -0,0 +1,33 @@
+# Books of the initial data: 1 "The Great Gatsby" at 10.99 and 2 "To Kill a Mockingbird" at 12.50
+
+
+def test_batch_rejects_values_of_the_wrong_type(client):
+    for book in ({'id': 1, 'title': 'A', 'author': 'B', 'price': '5', 'quantity': 1},
+                 {'id': 1, 'title': 'A', 'author': 'B', 'price': 5, 'quantity': 1.5},
+                 {'id': 1, 'title': 'A', 'author': 'B', 'price': True, 'quantity': 1},
+                 {'id': 1, 'title': None, 'author': 'B', 'price': 5, 'quantity': 1}):
+        response = client.put('/books/batch', json=[book])
+        assert response.status_code == 400, book
+    assert client.get('/books/1').get_json()['title'] == 'The Great Gatsby'
+
+
+# A cached page sorted by price is invalidated by a batch moving a book into it
+def test_batch_update_invalidates_cached_pages(client):
+    first_page = client.get('/books?limit=1&sort=price').get_json()
+    assert [book['id'] for book in first_page['books']] == [1]
+
+    response = client.put('/books/batch', json=[{'id': 2, 'title': 'T', 'author': 'A', 'price': 5, 'quantity': 1}])
+
+    assert response.status_code == 200
+    first_page = client.get('/books?limit=1&sort=price').get_json()
+    assert first_page['books'] == [{'id': 2, 'title': 'T', 'author': 'A', 'price': 5.0, 'quantity': 1}]
+
+
+# The ids returned by a batch insert follow the order of the books sent
+def test_batch_insert_returns_ids_in_order(client, service):
+    books = [{'title': f'Title {i}', 'author': 'Author', 'price': i, 'quantity': 1} for i in range(50)]
+
+    book_ids = client.post('/books/batch', json=books).get_json()['ids']
+
+    for book, book_id in zip(books, book_ids):
+        assert client.get(f'/books/{book_id}').get_json()['title'] == book['title']
@@ -0,0 +1,24 @@
+# A page the index forgets is dropped from the cache too, so a later write cannot leave it stale
+def test_evicted_pages_are_not_served_stale(service, client):
+    service.book_pages.max_pages = 3
+    assert client.get('/books?limit=1').get_json()['books'][0]['title'] == 'The Great Gatsby'
+    for sort in ('title', 'author', 'price'):
+        client.get(f'/books?limit=1&sort={sort}')
+
+    response = client.put('/books/1', json={'title': 'CHANGED', 'author': 'F. Scott Fitzgerald', 'price': 10.99,
+                                            'quantity': 5})
+    assert response.status_code == 200
+
+    assert client.get('/books?limit=1').get_json()['books'][0]['title'] == 'CHANGED'
+
+
+# A write drops only the cached pages whose range holds the changed book
+def test_write_invalidates_only_the_pages_holding_the_book(service, client):
+    client.get('/books?limit=1')
+    client.get('/books?limit=1&after_id=1')
+    cached_pages = set(service.book_pages.pages)
+
+    client.put('/books/2', json={'title': 'CHANGED', 'author': 'Harper Lee', 'price': 12.5, 'quantity': 3})
+
+    assert len(cached_pages - set(service.book_pages.pages)) == 1
+    assert client.get('/books?limit=1&after_id=1').get_json()['books'][0]['title'] == 'CHANGED'
@@ -0,0 +1,14 @@
+import pytest
+
+
+@pytest.mark.parametrize('limit', ['abc', '0', '1001', ''])
+def test_search_rejects_an_invalid_limit(client, limit):
+    response = client.get(f'/books/search?q=gatsby&limit={limit}')
+    assert response.status_code == 400
+    assert 'limit' in response.get_json()['error']
+
+
+def test_search_finds_books_by_prefix(client):
+    response = client.get('/books/search?q=gats&limit=5')
+    assert [book['title'] for book in response.get_json()] == ['The Great Gatsby']
+    assert client.get('/books/search?q=harper').get_json()[0]['id'] == 2
@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+from cache_backends import DistributedCache
+from cache_utils import CachedCollection, ReadThroughCache
+
+
+def create_collection():
+    cache = DistributedCache(num_shards=1, num_replicas=1)
+    read_through = ReadThroughCache(cache.get, cache.set, cache.acquire_lock, cache.release_lock, lock_wait=2.0)
+    return cache, CachedCollection('books', 'book', cache, read_through, cache.versions)
+
+
+def body(payload):
+    return json.loads(payload.body)
+
+
+# A refill of an entity that loaded it before a write does not overwrite the written entry
+def test_write_through_is_not_overwritten_by_a_slow_refill():
+    cache, books = create_collection()
+    loaded = threading.Event()
+
+    def load_before_write():
+        row = {'id': 2, 'title': 'Old'}
+        loaded.set()
+        time.sleep(0.2)
+        return row
+
+    refill = threading.Thread(target=books.fetch_entity, args=(2, load_before_write))
+    refill.start()
+    loaded.wait()
+    books.write_through([2], lambda ids: [{'id': 2, 'title': 'New'}])
+    refill.join()
+
+    assert body(cache.get('book:2'))['title'] == 'New'
+
+
+# A write patches the cached collection in place, byte for byte as a rebuild would encode it
+def test_write_through_patches_the_collection():
+    cache, books = create_collection()
+    rows = [{'id': i, 'title': f'Title {i}'} for i in range(1, 6)]
+    books.fetch(lambda: [dict(row) for row in rows])
+
+    rows[2]['title'] = 'A much longer title than before'
+    rows.append({'id': 6, 'title': 'Appended'})
+    stored = {row['id']: row for row in rows}
+    entities, patched = books.write_through([3, 6], lambda ids: [stored[entity_id] for entity_id in ids])
+    assert patched
+    assert entities == [rows[2], rows[5]]
+
+    payload, from_cache = books.fetch(lambda: [])
+    assert from_cache
+    assert body(payload) == rows
+    assert payload.body == books._build((0, rows), None).body
+
+
+# Entries are written from the rows read under the lock, so a write through that runs late cannot store an older row,
+# and they soft-expire like any rebuilt entry
+def test_late_write_through_stores_the_latest_row():
+    cache, books = create_collection()
+    database = {1: {'id': 1, 'title': 'Original'}}
+    books.fetch(lambda: list(database.values()))
+
+    def load(ids):
+        return [dict(database[entity_id]) for entity_id in ids]
+
+    # Both writes commit, then they write through in reverse order
+    database[1] = {'id': 1, 'title': 'First'}
+    database[1] = {'id': 1, 'title': 'Second'}
+    books.write_through([1], load)
+    books.write_through([1], load)
+
+    entry = cache.get('book:1')
+    assert body(entry)['title'] == 'Second'
+    assert entry.created_at is not None
+    assert body(books.fetch(lambda: [])[0]) == [{'id': 1, 'title': 'Second'}]
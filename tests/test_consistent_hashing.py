@@ -0,0 +1,60 @@
+from cache_backends import ConsistentHashing
+
+num_keys = 20000
+keys = [f'key:{i}' for i in range(num_keys)]
+
+
+def fill(ring):
+    for key in keys:
+        ring.get_node(key).set(key, key)
+
+
+def owners(ring):
+    return {key: ring.get_node(key).node_id for key in keys}
+
+
+# Adding a node to N nodes moves about 1/(N+1) of the keys, all of them to the new node
+def test_add_node_moves_only_the_new_nodes_share():
+    ring = ConsistentHashing(4)
+    fill(ring)
+    before = owners(ring)
+
+    moved = ring.add_node(4)
+
+    after = owners(ring)
+    changed = [key for key in keys if before[key] != after[key]]
+    assert moved == len(changed)
+    assert all(after[key] == 4 for key in changed)
+    assert 0.5 / 5 < moved / num_keys < 1.5 / 5
+    # Moved entries are served by their new owner
+    assert all(ring.get_node(key).get(key) == key for key in keys)
+
+
+# Removing one of N nodes moves only its keys, about 1/N of them, spread over the remaining nodes
+def test_remove_node_moves_only_its_keys():
+    ring = ConsistentHashing(5)
+    fill(ring)
+    before = owners(ring)
+
+    moved = ring.remove_node(2)
+
+    after = owners(ring)
+    changed = [key for key in keys if before[key] != after[key]]
+    assert sorted(changed) == sorted(key for key in keys if before[key] == 2)
+    assert moved == len(changed)
+    assert 0.5 / 5 < moved / num_keys < 1.5 / 5
+    assert len({after[key] for key in changed}) > 1
+    assert all(ring.get_node(key).get(key) == key for key in keys)
+
+
+# With 100 virtual nodes per node, every node owns close to an equal share of the keys
+def test_keys_spread_evenly():
+    ring = ConsistentHashing(8)
+    counts = {}
+    for owner in owners(ring).values():
+        counts[owner] = counts.get(owner, 0) + 1
+
+    share = num_keys / 8
+    assert len(counts) == 8
+    assert max(counts.values()) < 1.3 * share
+    assert min(counts.values()) > 0.7 * share
@@ -0,0 +1,46 @@
+import time
+from customer_store import CustomerStore
+from replication_log import ChangeLog, InterProcessLock, read_snapshot_seq
+
+
+def open_store(tmp_path, **options):
+    path = str(tmp_path / 'customers.json')
+    change_log = ChangeLog(str(tmp_path / 'changes.log'), max_entries=200,
+                           compacted_seq=lambda: read_snapshot_seq(path, 0))
+    return CustomerStore(path, change_log, InterProcessLock(path + '.lock'), **options)
+
+
+# Entries not yet compacted into the file are the only copy of those writes, so the log keeps them past max_entries
+def test_uncompacted_writes_survive_log_truncation(tmp_path):
+    store = open_store(tmp_path, compact_every=10 ** 6)
+    ids = store.insert_multiple([{'name': f'c{i}', 'email': f'c{i}@example.com'} for i in range(301)])
+
+    reloaded = open_store(tmp_path)
+
+    assert len(reloaded) == 301
+    assert reloaded.get(ids[-1])['name'] == 'c300'
+
+
+# Once compacted, the older half of the log is dropped again
+def test_log_is_truncated_after_compaction(tmp_path):
+    store = open_store(tmp_path, compact_every=10 ** 6)
+    store.insert_multiple([{'name': f'c{i}', 'email': f'c{i}@example.com'} for i in range(250)])
+    store.compact()
+    store.insert({'name': 'last', 'email': 'last@example.com'})
+
+    assert len(store.change_log.entries) <= 100
+    assert len(open_store(tmp_path)) == 251
+
+
+# Without a flush interval the file is only rewritten once compact_every entries are waiting
+def test_file_is_compacted_by_log_length(tmp_path):
+    store = open_store(tmp_path, compact_every=5)
+    store.insert_multiple([{'name': f'c{i}', 'email': f'c{i}@example.com'} for i in range(4)])
+    time.sleep(0.2)
+    assert read_snapshot_seq(store.path, 0) == 0
+
+    store.insert({'name': 'c4', 'email': 'c4@example.com'})
+    deadline = time.monotonic() + 5
+    while read_snapshot_seq(store.path, 0) < 5 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert read_snapshot_seq(store.path, 0) == 5
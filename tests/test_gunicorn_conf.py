@@ -0,0 +1,27 @@
+import os
+import runpy
+import pytest
+
+conf_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gunicorn.conf.py')
+
+
+def load_conf(monkeypatch, **env):
+    for name in ('CACHE_BACKEND', 'SERVICE_WORKERS'):
+        monkeypatch.delenv(name, raising=False)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    return runpy.run_path(conf_path)
+
+
+# Workers of the local backend do not see each other's writes, so it is served by one
+def test_local_backend_runs_one_worker(monkeypatch):
+    assert load_conf(monkeypatch)['workers'] == 1
+
+
+def test_local_backend_refuses_several_workers(monkeypatch):
+    with pytest.raises(RuntimeError):
+        load_conf(monkeypatch, SERVICE_WORKERS='2')
+
+
+def test_shared_backend_runs_several_workers(monkeypatch):
+    assert load_conf(monkeypatch, CACHE_BACKEND='redis', SERVICE_WORKERS='4')['workers'] == 4
@@ -0,0 +1,91 @@
+import threading
+import time
+from cache_backends import DistributedCache
+from cache_utils import ReadThroughCache, build_payload
+
+
+def create_read_through(**options):
+    cache = DistributedCache(num_shards=1, num_replicas=1)
+    return cache, ReadThroughCache(cache.get, cache.set, cache.acquire_lock, cache.release_lock, **options)
+
+
+# While one caller rebuilds a stale payload, the others are served the stale one instead of waiting
+def test_stale_payload_is_served_while_one_caller_rebuilds():
+    cache, read_through = create_read_through()
+    cache.set('books', build_payload(['old'], 'v1'))
+    loading = threading.Event()
+    release = threading.Event()
+    loads = []
+
+    def slow_load():
+        loads.append(1)
+        loading.set()
+        release.wait(5)
+        return ['new']
+
+    rebuild = threading.Thread(target=read_through.fetch, args=('books', slow_load, 'v2'))
+    rebuild.start()
+    loading.wait(5)
+
+    payload, from_cache = read_through.fetch('books', slow_load, 'v2')
+    release.set()
+    rebuild.join()
+
+    assert (payload.body, from_cache) == (b'["old"]', True)
+    assert read_through.stale_hits == 1
+    assert len(loads) == 1
+    assert read_through.fetch('books', slow_load, 'v2')[0].body == b'["new"]'
+
+
+# The rebuild lock held elsewhere, e.g. by another process, also serves the stale payload rather than rebuilding
+def test_stale_payload_is_served_while_another_process_holds_the_lock():
+    cache, read_through = create_read_through()
+    cache.set('books', build_payload(['old'], 'v1'))
+    assert cache.acquire_lock('books', 10)
+
+    payload, from_cache = read_through.fetch('books', lambda: ['new'], 'v2')
+
+    assert (payload.body, from_cache) == (b'["old"]', True)
+
+
+# A caller that must not be served stale data waits for the rebuilt payload instead
+def test_stale_payload_is_never_returned_without_allow_stale():
+    cache, read_through = create_read_through(lock_wait=5.0)
+    cache.set('books', build_payload(['old'], 'v1'))
+    token = cache.acquire_lock('books', 10)
+
+    def rebuild_elsewhere():
+        time.sleep(0.2)
+        cache.set('books', build_payload(['new'], 'v2')._replace(created_at=time.time()))
+        cache.release_lock('books', token)
+
+    threading.Thread(target=rebuild_elsewhere).start()
+    payload, from_cache = read_through.fetch('books', lambda: ['loaded here'], 'v2', allow_stale=False)
+
+    assert (payload.body, payload.etag, from_cache) == (b'["new"]', 'v2', False)
+
+
+# With nothing cached and the lock never released, the caller waits lock_wait seconds and then rebuilds itself
+def test_caller_losing_the_lock_rebuilds_after_waiting():
+    cache, read_through = create_read_through(lock_wait=0.3)
+    assert cache.acquire_lock('books', 10)
+
+    started = time.monotonic()
+    payload, from_cache = read_through.fetch('books', lambda: ['loaded here'], 'v1')
+
+    assert time.monotonic() - started >= 0.3
+    assert (payload.body, from_cache) == (b'["loaded here"]', False)
+    assert cache.get('books').body == b'["loaded here"]'
+
+
+# A payload nearing its soft expiry is refreshed early in proportion to the time it took to build
+def test_payload_is_refreshed_early_before_its_soft_expiry():
+    cache, read_through = create_read_through(soft_ttl=60, early_refresh_beta=1.0)
+    cache.set('books', build_payload(['cheap'])._replace(created_at=time.time() - 30, compute_time=0.001))
+    assert read_through.fetch('books', lambda: ['rebuilt'])[0].body == b'["cheap"]'
+
+    cache.set('books', build_payload(['expensive'])._replace(created_at=time.time() - 59, compute_time=10.0 ** 6))
+    payload, from_cache = read_through.fetch('books', lambda: ['rebuilt'])
+
+    assert (payload.body, from_cache) == (b'["rebuilt"]', False)
+    assert read_through.refreshes == 1
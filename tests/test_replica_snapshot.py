@@ -0,0 +1,42 @@
+import json
+import os
+from replication import ReplicaSnapshot
+
+
+def write(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    # Make the rewrite visible to the signature even within one clock tick
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+
+
+# A version read before a reload keeps its own body, ETag and compressed body
+def test_versions_are_not_changed_by_reloads(tmp_path):
+    path = str(tmp_path / 'replica.json')
+    write(path, {'customers': {'1': {'name': 'old'}}})
+    snapshot = ReplicaSnapshot(path)
+    old = snapshot.current()
+    old_body, old_etag = old.body, old.etag
+
+    write(path, {'customers': {'1': {'name': 'new'}}})
+    new = snapshot.current()
+
+    assert new is not old
+    assert (old.body, old.etag) == (old_body, old_etag)
+    assert b'old' in old.body and b'new' in new.body
+    assert new.etag != old.etag
+    assert old.compressed_body() != new.compressed_body()
+    assert snapshot.current() is new
+
+
+# A file that cannot be parsed leaves the previous version in place
+def test_unparsable_file_keeps_the_previous_version(tmp_path):
+    path = str(tmp_path / 'replica.json')
+    write(path, {'customers': {}})
+    snapshot = ReplicaSnapshot(path)
+    version = snapshot.current()
+
+    with open(path, 'w') as f:
+        f.write('{')
+
+    assert snapshot.current() is version
@@ -0,0 +1,78 @@
+import json
+import os
+from customer_store import CustomerStore
+from replication import ReplicaSnapshot
+from replication_log import ChangeLog, InterProcessLock, ReplicaSync, read_snapshot_seq, replica_tail_path
+
+
+def open_replication(tmp_path, max_tail=1000):
+    path = str(tmp_path / 'customers.json')
+    change_log = ChangeLog(str(tmp_path / 'changes.log'), compacted_seq=lambda: read_snapshot_seq(path, 0))
+    write_lock = InterProcessLock(path + '.lock')
+    store = CustomerStore(path, change_log, write_lock, compact_every=10 ** 6)
+    replica_path = str(tmp_path / 'replica.json')
+    return store, ReplicaSync(path, [replica_path], change_log, write_lock, max_tail=max_tail), replica_path
+
+
+def served_customers(snapshot):
+    return json.loads(snapshot.current().body)['customers']
+
+
+# A sync only appends the missing entries to the tail; the replica server applies them to the data it holds
+def test_sync_appends_to_the_tail_without_rewriting_the_file(tmp_path):
+    store, replica_sync, replica_path = open_replication(tmp_path)
+    doc_id = store.insert({'name': 'John', 'email': 'john@example.com', 'orders_count': 0})
+    store.compact()
+    assert replica_sync.sync(replica_path) == 'snapshot'
+    snapshot = ReplicaSnapshot(replica_path)
+    assert served_customers(snapshot)[str(doc_id)]['name'] == 'John'
+    file_stat = os.stat(replica_path)
+
+    store.update(doc_id, {'name': 'Johnny'})
+    store.increment_all('orders_count')
+
+    assert replica_sync.sync(replica_path) == 2
+    assert os.stat(replica_path).st_mtime_ns == file_stat.st_mtime_ns
+    assert replica_sync.read_seq(replica_path) == store.change_log.head_seq
+    assert served_customers(snapshot)[str(doc_id)] == {'name': 'Johnny', 'email': 'john@example.com',
+                                                       'orders_count': 1}
+
+
+# Once the tail would pass max_tail entries the file is rewritten from a snapshot and the tail emptied
+def test_long_tail_is_replaced_by_a_snapshot(tmp_path):
+    store, replica_sync, replica_path = open_replication(tmp_path, max_tail=3)
+    doc_id = store.insert({'name': 'John', 'email': 'john@example.com', 'orders_count': 0})
+    store.compact()
+    replica_sync.sync(replica_path)
+    snapshot = ReplicaSnapshot(replica_path)
+    served_customers(snapshot)
+
+    results = []
+    for _ in range(4):
+        store.increment_all('orders_count')
+        results.append(replica_sync.sync(replica_path))
+
+    assert results == [1, 1, 1, 'snapshot']
+    assert os.path.getsize(replica_tail_path(replica_path)) == 0
+    assert served_customers(snapshot)[str(doc_id)]['orders_count'] == 4
+
+
+# Before the store first compacts customers.json, a snapshot is built from the change log alone
+def test_snapshot_without_a_primary_file(tmp_path):
+    store, replica_sync, replica_path = open_replication(tmp_path)
+    doc_id = store.insert({'name': 'John', 'email': 'john@example.com', 'orders_count': 0})
+    assert not os.path.exists(store.path)
+
+    assert replica_sync.sync(replica_path) == 'snapshot'
+
+    assert replica_sync.read_seq(replica_path) == store.change_log.head_seq
+    assert served_customers(ReplicaSnapshot(replica_path))[str(doc_id)]['name'] == 'John'
+
+
+# A fresh service replicates its first customer writes without errors
+def test_fresh_service_replicates_without_errors(client):
+    assert client.post('/customers', json={'name': 'Jane', 'email': 'jane@example.com'}).status_code == 200
+
+    status = client.get('/replication/status').get_json()
+
+    assert all(replica['errors'] == 0 and replica['lag_entries'] == 0 for replica in status['replicas'].values())
@@ -0,0 +1,29 @@
+import json
+
+
+def test_ndjson_has_its_own_etag(client):
+    ndjson = client.get('/books', headers={'Accept': 'application/x-ndjson'})
+    array = client.get('/books')
+
+    assert ndjson.mimetype == 'application/x-ndjson'
+    assert [json.loads(line) for line in ndjson.data.splitlines()] == json.loads(array.data)
+    assert ndjson.headers['ETag'] != array.headers['ETag']
+    assert 'Accept' in ndjson.headers['Vary'] and 'Accept' in array.headers['Vary']
+
+    # The NDJSON ETag does not validate the JSON array, and the other way round
+    response = client.get('/books', headers={'If-None-Match': ndjson.headers['ETag']})
+    assert response.status_code == 200
+    response = client.get('/books?stream=ndjson', headers={'If-None-Match': array.headers['ETag']})
+    assert response.status_code == 200
+    response = client.get('/books?stream=ndjson', headers={'If-None-Match': ndjson.headers['ETag']})
+    assert response.status_code == 304
+    assert 'Accept' in response.headers['Vary']
+
+
+# A streamed JSON array is the same representation as the cached one
+def test_streamed_array_matches_the_cached_one(client):
+    streamed = client.get('/customers?stream=json')
+    cached = client.get('/customers')
+
+    assert streamed.data == cached.data
+    assert streamed.headers['ETag'] == cached.headers['ETag']
@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+import pytest
+from two_phase_commit import TransactionAborted, TransactionLog
+
+
+def book(title, book_id=None):
+    row = {'title': title, 'author': 'Author', 'price': 10.0, 'quantity': 1}
+    if book_id is not None:
+        row['id'] = book_id
+    return row
+
+
+def orders_counts(service):
+    return [customer['orders_count'] for customer in service.customers_store.all()]
+
+
+def book_titles(service):
+    with service.app.app_context():
+        return sorted(title for title, in service.db.session.query(service.Book.title))
+
+
+def commit_record(service, txids, books, amount):
+    return {'state': 'commit', 'txids': txids,
+            'redo': {'books': books, 'customers': {'after_seq': service.customers_change_log.head_seq,
+                                                   'amount': amount}}}
+
+
+def recover(service, orphaned_logs=()):
+    with service.app.app_context():
+        return service.two_phase_commit.recover(orphaned_logs)
+
+
+def write_records(path, records):
+    with open(path, 'wb') as f:
+        for record in records:
+            f.write((json.dumps(record) + '\n').encode('utf-8'))
+
+
+# Run the operations as one batch: they are queued while a leader is active, then the first to take over runs them
+def execute_batch(service, operations):
+    coordinator = service.two_phase_commit
+    results = [None] * len(operations)
+
+    def execute(position):
+        try:
+            with service.app.app_context():
+                results[position] = coordinator.execute(operations[position])
+        except TransactionAborted as e:
+            results[position] = e
+
+    with coordinator.condition:
+        coordinator.leader_active = True
+    threads = [threading.Thread(target=execute, args=(position,)) for position in range(len(operations))]
+    for thread in threads:
+        thread.start()
+    while len(coordinator.queue) < len(operations):
+        time.sleep(0.01)
+    with coordinator.condition:
+        coordinator.leader_active = False
+        coordinator.condition.notify_all()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# A row the database rejects aborts its own transaction only; the rest of the batch commits together
+def test_rejected_row_aborts_only_its_transaction(service):
+    results = execute_batch(service, [
+        {'books': book('First'), 'customers': 1},
+        {'books': book(None), 'customers': 1},
+        {'books': book('Third'), 'customers': 1},
+    ])
+
+    assert isinstance(results[1], TransactionAborted)
+    assert results[0]['books']['title'] == 'First' and results[2]['books']['title'] == 'Third'
+    assert 'First' in book_titles(service) and 'Third' in book_titles(service)
+    assert None not in book_titles(service)
+    assert orders_counts(service) == [2, 2]
+    # One commit record and one change log entry for the whole batch
+    increments = [entry for entry in service.customers_change_log.entries if entry['op'] == 'increment_all']
+    assert len(increments) == 1 and len(increments[0]['txids']) == 2
+
+
+# A transaction whose commit decision could not be logged is aborted in every participant
+def test_transaction_without_commit_record_is_aborted(service, monkeypatch):
+    def fail(record, sync=True):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(service.two_phase_commit.log, 'append', fail)
+    with pytest.raises(TransactionAborted), service.app.app_context():
+        service.two_phase_commit.execute({'books': book('Never'), 'customers': 1})
+
+    assert 'Never' not in book_titles(service)
+    assert orders_counts(service) == [0, 0]
+
+
+# A commit record cut short by a crash was never acknowledged, so recovery presumes the transaction aborted
+def test_recovery_presumes_abort_without_a_complete_commit_record(service):
+    record = json.dumps(commit_record(service, ['cut'], [book('Cut short', 100)], 1))
+    with open(service.two_phase_commit.log.path, 'wb') as f:
+        f.write(record[:len(record) // 2].encode('utf-8'))
+
+    assert recover(service) == 0
+    assert 'Cut short' not in book_titles(service)
+    assert orders_counts(service) == [0, 0]
+
+
+# A commit record without an end record is committed by recovery, exactly once
+def test_recovery_commits_a_decided_transaction_once(service):
+    write_records(service.two_phase_commit.log.path, [commit_record(service, ['decided'], [book('Decided', 100)], 1)])
+
+    assert recover(service) == 1
+    assert recover(service) == 0
+
+    assert book_titles(service).count('Decided') == 1
+    assert orders_counts(service) == [1, 1]
+
+
+# Recovering a transaction that did commit before the crash, but whose end record was lost, changes nothing
+def test_recovery_does_not_repeat_a_committed_transaction(service):
+    log_path = service.two_phase_commit.log.path
+    with service.app.app_context():
+        service.two_phase_commit.execute({'books': book('Committed'), 'customers': 1})
+    with open(log_path, 'rb') as f:
+        records = [json.loads(line) for line in f]
+    write_records(log_path, [record for record in records if record['state'] == 'commit'])
+
+    assert recover(service) == 1
+
+    assert book_titles(service).count('Committed') == 1
+    assert orders_counts(service) == [1, 1]
+
+
+# The log of a process that is gone is claimed, recovered and removed; one still held by its process is left alone
+def test_orphaned_transaction_log_is_claimed_and_removed(service):
+    orphan_path = os.path.join(service.data_dir, 'transactions-999999.log')
+    write_records(orphan_path, [commit_record(service, ['orphan'], [book('Orphaned', 100)], 1)])
+    held = TransactionLog(os.path.join(service.data_dir, 'transactions-999998.log'))
+    assert held.claim()
+
+    orphans = service.orphaned_transaction_logs()
+
+    assert [log.path for log in orphans] == [orphan_path]
+    assert recover(service, orphans) == 1
+    assert not os.path.exists(orphan_path)
+    assert os.path.exists(held.path)
+    assert 'Orphaned' in book_titles(service)
+    assert orders_counts(service) == [1, 1]
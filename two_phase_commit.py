@@ -0,0 +1,334 @@
+import json
+import logging
+import os
+import threading
+import uuid
+from sqlalchemy import insert, select
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where every log counts as claimed by the current process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+# Raised to the caller of a transaction that was aborted
+class TransactionAborted(Exception):
+    pass
+
+
+# Durable log of the coordinator's decisions, one JSON record per line:
+#   {"state": "commit", "txids": [...], "redo": {participant: data}}  fsynced before any participant commits
+#   {"state": "end", "txids": [...]}                                    every participant has committed
+# Transactions without a commit record are presumed aborted, so aborts are never logged.
+# Processes committing side by side, e.g. the workers of a server, each keep their own log and hold a lock on it
+# (claim) for as long as they run, so a log can be recovered by another process once its owner is gone.
+class TransactionLog:
+    def __init__(self, path, max_records=1000):
+        self.path = path
+        # The log is emptied once it holds this many records and no transaction is unfinished
+        self.max_records = max_records
+        self.records = 0
+        # The log file, kept open while this process holds the lock on it
+        self.file = None
+
+    # Lock the log for this process, creating it if needed; returns False if another running process holds it
+    def claim(self):
+        if fcntl is None or self.file is not None:
+            return True
+        file = open(self.path, 'ab')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+        self.file = file
+        return True
+
+    # Append a record, waiting for it to reach the disk if sync is set
+    def append(self, record, sync=True):
+        with open(self.path, 'ab') as f:
+            f.write((json.dumps(record) + '\n').encode('utf-8'))
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        self.records += 1
+
+    # Commit records of the transactions that were decided but not finished
+    def unfinished(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        decided = {}
+        # A line cut short by a crash was never acknowledged and is ignored
+        for line in data[:data.rfind(b'\n') + 1].splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            key = tuple(record['txids'])
+            if record['state'] == 'commit':
+                decided[key] = record
+            elif record['state'] == 'end':
+                decided.pop(key, None)
+        return list(decided.values())
+
+    # Drop every record; only valid while no transaction is unfinished.
+    # The file is emptied in place rather than replaced, as the lock claiming it is held on the file
+    def reset(self):
+        open(self.path, 'wb').close()
+        self.records = 0
+
+    # Delete the log of a process that is gone, once it is recovered
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# A transaction submitted to the coordinator: one operation per participant, keyed by participant name
+class Transaction:
+    def __init__(self, operation):
+        self.txid = uuid.uuid4().hex
+        self.operation = operation
+        # Participant name -> what the participant produced, e.g. the inserted row
+        self.results = {}
+        self.error = None
+        self.done = False
+
+
+# Two-phase commit coordinator with group commit.
+# Concurrent transactions are queued and run in batches by one leader thread at a time: every participant
+# prepares the whole batch, a single fsynced commit record makes the decision durable, and every participant
+# commits the batch at once, so the transactions of a batch share their fsyncs.
+# Transactions a participant cannot prepare are aborted on their own and the rest of the batch is prepared again.
+# Participants implement prepare(transactions) -> {txid: reason rejected}, redo(transactions) -> data needed to
+# commit them again, commit(transactions), abort(transactions) and recover(txids, redo data).
+class TwoPhaseCommitCoordinator:
+    def __init__(self, log, participants, max_batch=100):
+        self.log = log
+        self.participants = participants
+        self.max_batch = max_batch
+        self.condition = threading.Condition()
+        self.queue = []
+        self.leader_active = False
+
+    # Run a transaction and return its results, raising TransactionAborted if it was aborted
+    def execute(self, operation):
+        transaction = Transaction(operation)
+        with self.condition:
+            self.queue.append(transaction)
+            # Wait for the current leader to run this transaction, or take over once it has stepped down
+            while not transaction.done and self.leader_active:
+                self.condition.wait()
+            leader = not transaction.done
+            if leader:
+                self.leader_active = True
+
+        if leader:
+            try:
+                while not transaction.done:
+                    with self.condition:
+                        batch = self.queue[:self.max_batch]
+                        del self.queue[:self.max_batch]
+                    self._run(batch)
+            finally:
+                with self.condition:
+                    self.leader_active = False
+                    self.condition.notify_all()
+
+        if transaction.error is not None:
+            raise TransactionAborted(transaction.error)
+        return transaction.results
+
+    # Finish the transactions that were decided before a crash, in this coordinator's log and in the logs left by
+    # other coordinators that are gone (claimed by the caller), returning how many records were recovered
+    def recover(self, orphaned_logs=()):
+        recovered = 0
+        for log in [self.log, *orphaned_logs]:
+            records = log.unfinished()
+            for record in records:
+                for participant in self.participants:
+                    participant.recover(record['txids'], record['redo'].get(participant.name))
+                log.append({'state': 'end', 'txids': record['txids']}, sync=False)
+                logger.info(f"Recovered committed transactions {', '.join(record['txids'])}")
+            recovered += len(records)
+            if log is self.log:
+                log.reset()
+            else:
+                log.remove()
+        return recovered
+
+    def _run(self, batch):
+        pending = list(batch)
+        while pending:
+            # Phase 1: every participant prepares the batch
+            prepared = []
+            rejected = {}
+            try:
+                for participant in self.participants:
+                    prepared.append(participant)
+                    rejected = participant.prepare(pending)
+                    if rejected:
+                        break
+            except Exception as e:
+                rejected = {transaction.txid: str(e) for transaction in pending}
+            if rejected:
+                self._abort(prepared, pending)
+                self._finish([transaction for transaction in pending if transaction.txid in rejected], rejected)
+                pending = [transaction for transaction in pending if transaction.txid not in rejected]
+                continue
+
+            # The decision is durable once the commit record is on disk
+            txids = [transaction.txid for transaction in pending]
+            try:
+                self.log.append({'state': 'commit', 'txids': txids,
+                                 'redo': {participant.name: participant.redo(pending)
+                                          for participant in self.participants}})
+            except Exception as e:
+                self._abort(prepared, pending)
+                self._finish(pending, {txid: f'Failed to log the commit decision: {str(e)}' for txid in txids})
+                return
+
+            # Phase 2: every participant commits; a failed commit is redone now or at the next recovery
+            finished = True
+            for participant in self.participants:
+                try:
+                    participant.commit(pending)
+                except Exception as e:
+                    logger.error(f'Participant {participant.name} failed to commit, redoing it: {str(e)}')
+                    try:
+                        participant.recover(txids, participant.redo(pending))
+                    except Exception as e:
+                        logger.error(f'Participant {participant.name} will commit at the next recovery: {str(e)}')
+                        finished = False
+            if finished:
+                self.log.append({'state': 'end', 'txids': txids}, sync=False)
+                if self.log.records >= self.log.max_records:
+                    self.log.reset()
+            self._finish(pending, {})
+            return
+
+    def _abort(self, participants, transactions):
+        for participant in reversed(participants):
+            try:
+                participant.abort(transactions)
+            except Exception as e:
+                logger.error(f'Participant {participant.name} failed to abort: {str(e)}')
+
+    def _finish(self, transactions, errors):
+        with self.condition:
+            for transaction in transactions:
+                transaction.error = errors.get(transaction.txid)
+                transaction.done = True
+            self.condition.notify_all()
+
+
+# Participant inserting one row per transaction into a SQL table.
+# A batch is prepared inside one database transaction with a savepoint per row, so a row that cannot be
+# inserted only rejects its own transaction; the database transaction stays open until commit or abort.
+class SQLInsertParticipant:
+    def __init__(self, name, get_engine, table):
+        self.name = name
+        self.get_engine = get_engine
+        self.table = table
+        self.connection = None
+        self.transaction = None
+
+    def prepare(self, transactions):
+        self.connection = self.get_engine().connect()
+        self.transaction = self.connection.begin()
+        # pysqlite only opens a transaction before a DML statement, and a savepoint outside of one commits when
+        # released; opening it explicitly also takes the write lock up front
+        if self.connection.dialect.name == 'sqlite':
+            self.connection.exec_driver_sql('BEGIN IMMEDIATE')
+        rejected = {}
+        for transaction in transactions:
+            savepoint = self.connection.begin_nested()
+            try:
+                row = self.connection.execute(insert(self.table).values(**transaction.operation[self.name])
+                                              .returning(*self.table.c)).mappings().one()
+                savepoint.commit()
+                transaction.results[self.name] = dict(row)
+            except Exception as e:
+                savepoint.rollback()
+                rejected[transaction.txid] = str(e)
+        return rejected
+
+    # The inserted rows, with their ids, so they can be inserted again after a crash
+    def redo(self, transactions):
+        return [transaction.results[self.name] for transaction in transactions]
+
+    def commit(self, transactions):
+        try:
+            self.transaction.commit()
+        finally:
+            self._close()
+
+    def abort(self, transactions):
+        if self.transaction is not None:
+            try:
+                self.transaction.rollback()
+            finally:
+                self._close()
+
+    # Insert the rows of committed transactions that did not reach the database
+    def recover(self, txids, rows):
+        primary_key = self.table.primary_key.columns.values()[0]
+        with self.get_engine().begin() as connection:
+            existing = set(connection.execute(
+                select(primary_key).where(primary_key.in_([row[primary_key.name] for row in rows]))).scalars())
+            missing = [row for row in rows if row[primary_key.name] not in existing]
+            if missing:
+                connection.execute(insert(self.table), missing)
+
+    def _close(self):
+        self.connection.close()
+        self.connection = None
+        self.transaction = None
+
+
+# Participant adding an amount to a counter of every customer for each transaction.
+# Increments commute, so preparing only checks that the store is readable and notes the change log position;
+# a batch commits as a single change log entry tagged with its transaction ids.
+class CounterParticipant:
+    def __init__(self, name, store, field):
+        self.name = name
+        self.store = store
+        self.field = field
+        self.after_seq = None
+
+    def prepare(self, transactions):
+        self.store.refresh()
+        self.after_seq = self.store.change_log.head_seq
+        return {}
+
+    def redo(self, transactions):
+        return {'after_seq': self.after_seq,
+                'amount': sum(transaction.operation[self.name] for transaction in transactions)}
+
+    def commit(self, transactions):
+        self.store.increment_all(self.field, sum(transaction.operation[self.name] for transaction in transactions),
+                                 txids=[transaction.txid for transaction in transactions])
+
+    def abort(self, transactions):
+        pass
+
+    # Apply the increment of committed transactions unless the change log already has it
+    def recover(self, txids, redo):
+        self.store.refresh()
+        entries = self.store.change_log.entries_since(redo['after_seq'])
+        if entries is None:
+            logger.error(f"Change log no longer covers transactions {', '.join(txids)}, "
+                         f"their {self.field} increment is assumed to be applied")
+            return
+        if any(entry.get('txids') == txids for entry in entries):
+            return
+        self.store.increment_all(self.field, redo['amount'], txids=txids)